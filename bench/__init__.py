@@ -0,0 +1 @@
+# benchmarks: synthetic trail generator (synth) and WSGI load harness (load)
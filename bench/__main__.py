@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# python -m bench run|compare: generate a trail, import it, load-test NLPApp, save/compare JSON results
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import sqlite3
+import argparse
+import platform
+import subprocess
+
+from bench.synth import generate_trail, measure_import
+from bench.load import LoadHarness
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_media(value):
+    """'jpg=2,mp3=1' -> {'jpg': 2, 'mp3': 1}"""
+    media = {}
+    for part in filter(None, value.split(",")):
+        extension, _, count = part.partition("=")
+        media[extension] = int(count or 1)
+    return media
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    # Configured before the importer and app so their DEBUG file logging does not skew the numbers
+    logging.basicConfig(level=getattr(logging, args.log_level), format="%(asctime)s [%(levelname)s] %(message)s")
+
+    trail_path = os.path.join(args.workdir, "trail")
+    db_path = os.path.join(args.workdir, "bench.db")
+    params = {"depth": args.depth, "fanout": args.fanout, "rtf_per_folder": args.rtf_per_folder,
+              "rtf_size": args.rtf_size, "media": parse_media(args.media)}
+
+    # Reuse the generated tree when the parameters did not change
+    params_file = os.path.join(args.workdir, "params.json")
+    previous = None
+    if os.path.exists(params_file):
+        with open(params_file) as f:
+            previous = json.load(f)
+    if previous != params:
+        shutil.rmtree(trail_path, ignore_errors=True)
+        os.makedirs(args.workdir, exist_ok=True)
+        started = time.perf_counter()
+        counts = generate_trail(trail_path, seed=args.seed, **params)
+        print(f"Generated {counts['folders']} folders, {counts['rtf']} RTF and {counts['media']} media files "
+              f"in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+        with open(params_file, "w") as f:
+            json.dump(params, f)
+
+    import_result = measure_import(trail_path, db_path, mode=args.import_mode, workers=args.workers)
+    print(f"Import ({args.import_mode}): {import_result['files']} files, {import_result['files_per_second']} files/s",
+          file=sys.stderr)
+
+    with sqlite3.connect(db_path) as conn:
+        entries = conn.execute("SELECT COUNT(*) FROM file_entries").fetchone()[0]
+
+    from nlpapp import NLPApp
+    app = NLPApp(template_dir=os.path.join(REPO_DIR, "templates"), db_path=db_path,
+                 use_tree_index=not args.no_tree_index, page_cache_size=args.page_cache_size,
+                 stream_pages=args.stream_pages)
+    harness = LoadHarness(app, db_path, seed=args.seed)
+
+    routes = {}
+    for route in args.routes.split(","):
+        routes[route] = harness.run_route(route, requests=args.requests, concurrency=args.concurrency)
+        r = routes[route]
+        print(f"{route:8s} p50 {r['p50_ms']}ms  p95 {r['p95_ms']}ms  p99 {r['p99_ms']}ms  "
+              f"{r['requests_per_second']} req/s  peak RSS {r['peak_rss_kib']} KiB", file=sys.stderr)
+
+    result = {
+            "meta": {
+                    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                    "git_revision": git_revision(),
+                    "python": platform.python_version(),
+                    "sqlite": sqlite3.sqlite_version,
+                    "platform": platform.platform(),
+                    "entries": entries,
+                    "params": params,
+                    "options": {"use_tree_index": not args.no_tree_index, "page_cache_size": args.page_cache_size,
+                                "stream_pages": args.stream_pages, "requests": args.requests, "concurrency": args.concurrency},
+            },
+            "import": import_result,
+            "routes": routes,
+    }
+    output = args.output or os.path.join(args.workdir, time.strftime("results-%Y%m%d-%H%M%S.json"))
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"Results written to {output}", file=sys.stderr)
+
+
+def compare(args):
+    """Print the relative change of every metric between two result files."""
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    def row(label, old, new, lower_is_better=True):
+        if old in (None, 0) or new is None:
+            print(f"{label:36s} {old!s:>10} -> {new!s:>10}")
+            return
+        change = (new - old) / old * 100
+        better = change < 0 if lower_is_better else change > 0
+        print(f"{label:36s} {old:>10} -> {new:>10}  {change:+6.1f}% {'better' if better else 'worse'}")
+
+    row("import files/s", baseline["import"]["files_per_second"], candidate["import"]["files_per_second"], False)
+    for route in sorted(set(baseline["routes"]) & set(candidate["routes"])):
+        old, new = baseline["routes"][route], candidate["routes"][route]
+        for metric in ("p50_ms", "p95_ms", "p99_ms"):
+            row(f"{route} {metric}", old[metric], new[metric])
+        row(f"{route} requests/s", old["requests_per_second"], new["requests_per_second"], False)
+        row(f"{route} peak_rss_kib", old["peak_rss_kib"], new["peak_rss_kib"])
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench", description="Benchmarks for the importer and NLPApp.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="generate a trail, import it and load-test the app")
+    run_parser.add_argument("--workdir", default="/tmp/nlpapp-bench")
+    run_parser.add_argument("--output", default=None, help="result file (default: <workdir>/results-<timestamp>.json)")
+    run_parser.add_argument("--depth", type=int, default=3)
+    run_parser.add_argument("--fanout", type=int, default=10, help="subfolders per folder (depth 3, fanout 10: 1111 folders)")
+    run_parser.add_argument("--rtf-per-folder", type=int, default=6)
+    run_parser.add_argument("--rtf-size", type=int, default=2000, help="approximate characters per RTF text")
+    run_parser.add_argument("--media", default="jpg=2,mp3=1", help="media files per folder, e.g. jpg=2,mp3=1,mp4=0")
+    run_parser.add_argument("--import-mode", choices=("sequential", "parallel", "sync"), default="sequential")
+    run_parser.add_argument("--workers", type=int, default=None)
+    run_parser.add_argument("--routes", default="index,entry,save")
+    run_parser.add_argument("--requests", type=int, default=500)
+    run_parser.add_argument("--concurrency", type=int, default=4)
+    run_parser.add_argument("--page-cache-size", type=int, default=512, help="0 disables the page cache")
+    run_parser.add_argument("--no-tree-index", action="store_true", help="use the SQL navigation queries")
+    run_parser.add_argument("--stream-pages", action="store_true", help="stream entry pages while they render")
+    run_parser.add_argument("--seed", type=int, default=1)
+    run_parser.add_argument("--log-level", default="WARNING")
+    run_parser.set_defaults(func=run)
+
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, REPO_DIR)
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# drives NLPApp as a WSGI callable and reports latency, throughput and memory per route
+import io
+import os
+import time
+import random
+import sqlite3
+import threading
+from urllib.parse import urlencode
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def current_rss_kib():
+    """Resident set size of this process, from /proc where available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class RSSSampler:
+    """Samples current_rss_kib() in a background thread; peak is the highest value seen."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = current_rss_kib()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        rss = current_rss_kib()
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+
+def call_app(app, path, method="GET", query="", body=b"", headers=None):
+    """Runs one request through the app and returns (status, body length)."""
+    environ = {
+            "PATH_INFO": path,
+            "REQUEST_METHOD": method,
+            "QUERY_STRING": query,
+            "CONTENT_LENGTH": str(len(body)),
+            "CONTENT_TYPE": "application/x-www-form-urlencoded",
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.url_scheme": "http",
+            "SERVER_NAME": "bench",
+            "SERVER_PORT": "80",
+    }
+    environ.update(headers or {})
+    result = {}
+
+    def start_response(status, response_headers, exc_info=None):
+        result["status"] = status
+
+    iterable = app(environ, start_response)
+    try:
+        length = sum(len(chunk) for chunk in iterable)
+    finally:
+        if hasattr(iterable, "close"):
+            iterable.close()
+    return result.get("status"), length
+
+
+class LoadHarness:
+    """Fires requests at an NLPApp instance from a pool of threads."""
+
+    def __init__(self, app, db_path, seed=1):
+        self.app = app
+        self.rng = random.Random(seed)
+        conn = sqlite3.connect(db_path)
+        try:
+            self.folder_ids = [r[0] for r in conn.execute("SELECT id FROM file_entries WHERE entry_type = 'folder'")]
+            self.text_entries = conn.execute(
+                    "SELECT id, parent_id FROM file_entries WHERE entry_type = 'file' AND content IS NOT NULL").fetchall()
+        finally:
+            conn.close()
+
+    def make_request(self, route):
+        """Build the (path, method, query, body) of a request for a route name."""
+        if route == "index":
+            return "/", "GET", "", b""
+        if route == "entry":
+            return f"/entry/{self.rng.choice(self.folder_ids)}", "GET", "", b""
+        if route == "search":
+            return "/search", "GET", "q=buche", b""
+        if route == "save":
+            entry_id, parent_id = self.rng.choice(self.text_entries)
+            body = urlencode({"id": entry_id, "parent_id": parent_id,
+                              "content": f"Bench edit {self.rng.random()}"}).encode("utf-8")
+            return "/save", "POST", "", body
+        raise ValueError(f"Unknown route {route}")
+
+    def run_route(self, route, requests=500, concurrency=4, warmup=20):
+        """Measure one route; returns a dictionary of latency percentiles, throughput and memory."""
+        for _ in range(warmup):
+            call_app(self.app, *self.make_request(route))
+
+        # Requests are generated up front so the RNG is not shared between threads
+        planned = [self.make_request(route) for _ in range(requests)]
+        latencies = []
+        statuses = {}
+        lock = threading.Lock()
+
+        def worker(chunk):
+            local_latencies = []
+            local_statuses = {}
+            for request in chunk:
+                started = time.perf_counter()
+                status, _ = call_app(self.app, *request)
+                local_latencies.append(time.perf_counter() - started)
+                local_statuses[status] = local_statuses.get(status, 0) + 1
+            with lock:
+                latencies.extend(local_latencies)
+                for status, count in local_statuses.items():
+                    statuses[status] = statuses.get(status, 0) + count
+
+        chunks = [planned[i::concurrency] for i in range(concurrency)]
+        threads = [threading.Thread(target=worker, args=(chunk,)) for chunk in chunks]
+        with RSSSampler() as rss:
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            wall = time.perf_counter() - started
+
+        latencies.sort()
+        to_ms = lambda seconds: round(seconds * 1000, 3) if seconds is not None else None
+        return {
+                "requests": len(latencies),
+                "concurrency": concurrency,
+                "statuses": statuses,
+                "p50_ms": to_ms(percentile(latencies, 0.50)),
+                "p95_ms": to_ms(percentile(latencies, 0.95)),
+                "p99_ms": to_ms(percentile(latencies, 0.99)),
+                "max_ms": to_ms(latencies[-1] if latencies else None),
+                "requests_per_second": round(len(latencies) / wall, 1) if wall else None,
+                # Highest RSS sampled while this route ran; ru_maxrss would carry over earlier routes' peaks
+                "peak_rss_kib": rss.peak,
+                "rss_kib": current_rss_kib(),
+        }
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# synthetic trail generator and importer throughput measurement
+import os
+import time
+import random
+import importlib
+
+WORDS = ("Buche Eiche Ahorn Fichte Kiefer Birke Erle Linde Moos Farn Specht Meise Amsel Fuchs Dachs Reh "
+         "Wald Wiese Bach Teich Ufer Rinde Blatt Wurzel Knospe Frucht Samen Pilz Flechte Käfer Libelle").split()
+
+# Media types in the mix: extension -> size in bytes
+MEDIA_SIZES = {"jpg": 200 * 1024, "mp3": 500 * 1024, "mp4": 1024 * 1024}
+
+
+def rtf_document(text):
+    """Minimal RTF wrapping plain text, the way the trail exports look."""
+    body = text.replace("\\", "\\\\").replace("{", "\\{").replace("}", "\\}").replace("\n", "\\par\n")
+    return "{\\rtf1\\ansi\\ansicpg1252{\\fonttbl\\f0 Helvetica;}\\f0 " + body + "\\par}"
+
+
+def paragraph(rng, size):
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)
+
+
+def generate_trail(base_path, depth=3, fanout=5, rtf_per_folder=2, rtf_size=2000, media=None, seed=1):
+    """Writes a folder tree with titel.rtf, numbered RTF texts and media files.
+
+    media maps an extension from MEDIA_SIZES to the number of such files per
+    folder, e.g. {"jpg": 2, "mp3": 1}. Returns counts of what was written.
+    """
+    rng = random.Random(seed)
+    media = {"jpg": 1, "mp3": 1} if media is None else media
+    counts = {"folders": 0, "rtf": 0, "media": 0, "bytes": 0}
+
+    def write(path, data):
+        with open(path, "wb") as f:
+            f.write(data)
+        counts["bytes"] += len(data)
+
+    stack = [(base_path, 0)]
+    while stack:
+        folder_path, level = stack.pop()
+        os.makedirs(folder_path, exist_ok=True)
+        counts["folders"] += 1
+        write(os.path.join(folder_path, "titel.rtf"),
+              rtf_document(f"{rng.choice(WORDS)} {counts['folders']}").encode("cp1252"))
+
+        position = 1
+        for _ in range(rtf_per_folder):
+            text = "\n\n".join(paragraph(rng, 400) for _ in range(max(rtf_size // 400, 1)))
+            write(os.path.join(folder_path, f"{position:02d}-text.rtf"), rtf_document(text).encode("cp1252"))
+            counts["rtf"] += 1
+            position += 1
+        for extension, count in media.items():
+            for _ in range(count):
+                write(os.path.join(folder_path, f"{position:02d}-media.{extension}"), rng.randbytes(MEDIA_SIZES[extension]))
+                counts["media"] += 1
+                position += 1
+
+        if level < depth:
+            for child in range(fanout):
+                stack.append((os.path.join(folder_path, f"station{child + 1:03d}"), level + 1))
+    return counts
+
+
+def measure_import(base_path, db_path, mode="sequential", workers=None):
+    """Imports a tree through RTFImporter and reports files per second."""
+    importer_module = importlib.import_module("import")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+
+    importer = importer_module.RTFImporter(base_path, db_path)
+    started = time.perf_counter()
+    if mode == "parallel":
+        importer.import_parallel(workers=workers)
+    elif mode == "sync":
+        importer.import_to_sqlite()
+        started = time.perf_counter()
+        importer.sync_to_sqlite()
+    else:
+        importer.import_to_sqlite()
+    elapsed = time.perf_counter() - started
+
+    files = sum(len([f for f in names if not f.startswith(".")]) for _, _, names in os.walk(base_path))
+    return {"mode": mode, "files": files, "seconds": round(elapsed, 3),
+            "files_per_second": round(files / elapsed, 1) if elapsed else None}
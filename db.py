@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# persistent per-thread sqlite connections for the app server
+import os
+import logging
+import sqlite3
+import threading
+from urllib.parse import quote
+
+
+class ConnectionManager:
+    """Keeps one tuned SQLite connection per thread and reopens it when the database file is replaced.
+
+    The importer only renames files over databases that are not in WAL mode,
+    i.e. served read-only; it rewrites WAL databases in place (see
+    import.py install_database), so writable servers keep their connections.
+    """
+
+    def __init__(self, db_path, wal=True, mmap_size=256 * 1024 * 1024, cache_size_kib=64 * 1024, cached_statements=256,
+                 read_only=False):
+        self.db_path = db_path
+        self.wal = wal
+        # Open with mode=ro&immutable=1: no locks, no journal or WAL lookups. Only safe when the
+        # file is never written in place, which holds for databases the importer swaps in; WAL
+        # databases are updated in place, so they are opened with plain mode=ro
+        self.read_only = read_only
+        self.mmap_size = mmap_size
+        self.cache_size_kib = cache_size_kib
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+
+    def _file_id(self):
+        try:
+            st = os.stat(self.db_path)
+            return (st.st_dev, st.st_ino)
+        except OSError:
+            return None
+
+    def _is_wal(self):
+        """True if the database header says WAL mode; immutable connections report 'delete' regardless."""
+        try:
+            with open(self.db_path, "rb") as f:
+                header = f.read(20)
+        except OSError:
+            return False
+        # File format write and read versions, both 2 in WAL mode
+        return len(header) == 20 and header[18] == 2 and header[19] == 2
+
+    def _open(self):
+        if self.read_only:
+            uri = f"file:{quote(os.path.abspath(self.db_path))}?mode=ro"
+            if self._is_wal():
+                # Immutable readers would ignore the -wal file and the importer's in-place updates
+                logging.warning(f"{self.db_path} is in WAL mode, reading it with locks; "
+                                "switch it with PRAGMA journal_mode=DELETE to serve it immutable")
+            else:
+                uri += "&immutable=1"
+            conn = sqlite3.connect(uri, uri=True, cached_statements=self.cached_statements)
+        else:
+            conn = sqlite3.connect(self.db_path, cached_statements=self.cached_statements)
+        if self.wal and not self.read_only:
+            try:
+                # WAL lets /save writes proceed without blocking readers; it is persistent in the file
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+            except sqlite3.DatabaseError as e:
+                logging.warning(f"Could not enable WAL on {self.db_path}: {e}")
+        conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        conn.execute(f"PRAGMA cache_size=-{int(self.cache_size_kib)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def connection(self):
+        """Return this thread's connection, reconnecting if the database file changed identity.
+
+        A thread holds on to a replaced file until its next call; connections of
+        threads that exit are closed with their thread-local storage.
+        """
+        local = self._local
+        conn = getattr(local, "conn", None)
+        file_id = self._file_id()
+        if conn is not None and file_id is not None and file_id != local.file_id:
+            logging.info(f"Database file {self.db_path} was replaced, reconnecting")
+            self.close()
+            conn = None
+        if conn is None:
+            conn = self._open()
+            local.conn = conn
+            local.file_id = self._file_id()
+        return conn
+
+    def is_current(self):
+        """True if this thread's connection is to the file now at db_path.
+
+        Ask inside a write transaction: a file renamed over the database
+        after the check would otherwise still miss the write.
+        """
+        return getattr(self._local, "conn", None) is not None and self._local.file_id == self._file_id()
+
+    def close(self):
+        """Close this thread's connection, if any."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            try:
+                conn.close()
+            finally:
+                self._local.conn = None
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# export the trail pages to static HTML files that Apache can serve directly
+import os
+import sys
+import gzip
+import json
+import time
+import logging
+import argparse
+import tempfile
+import threading
+
+MANIFEST_NAME = "manifest.json"
+
+
+class StaticExporter:
+    """Writes rendered NLPApp pages to a directory and keeps them current after edits.
+
+    Layout: index.html for '/', entry/<id>.html for '/entry/<id>', each with an
+    optional precompressed .gz sibling. Apache can map the app routes onto it, e.g.
+
+        RewriteCond %{DOCUMENT_ROOT}/static/entry/$1.html -f
+        RewriteRule ^/app/entry/(\\d+)$ /static/entry/$1.html [L]
+
+    manifest.json records which entries every exported page depends on, so an
+    edit only regenerates the pages that show the edited entry. The app calls
+    refresh() from request threads; pages render outside the lock, which only
+    covers writing a page and the manifest.
+    """
+
+    def __init__(self, app, out_dir, compress=True):
+        self.app = app
+        self.out_dir = out_dir
+        self.compress = compress
+        self._manifest = None
+        self._lock = threading.RLock()
+        # Renders are numbered so an older one never overwrites a newer one of the same route
+        self._renders = 0
+        self._written = {}
+        # Tags waiting for the background refresh thread, see refresh_later()
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        self._worker = None
+
+    def page_file(self, route):
+        """Relative output file for a route."""
+        if route == '/':
+            return "index.html"
+        return os.path.join("entry", route.split('/')[2] + ".html")
+
+    def routes(self):
+        """Every exportable route: the index and one page per folder."""
+        index = self.app.get_tree_index()
+        return ['/'] + [f"/entry/{node_id}" for node_id, node in index.nodes.items() if node["entry_type"] == "folder"]
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            path = os.path.join(self.out_dir, MANIFEST_NAME)
+            try:
+                with open(path, encoding="utf-8") as f:
+                    self._manifest = json.load(f)
+            except (OSError, ValueError):
+                self._manifest = {"pages": {}}
+        return self._manifest
+
+    def _write_atomic(self, rel_path, data):
+        """Write data unless the file already holds exactly these bytes. Returns True if written."""
+        path = os.path.join(self.out_dir, rel_path)
+        try:
+            with open(path, "rb") as f:
+                if f.read() == data:
+                    return False
+        except OSError:
+            pass
+
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        return True
+
+    def export_page(self, route):
+        """Render one route and write it. Returns True if the file changed."""
+        with self._lock:
+            self._renders += 1
+            ticket = self._renders
+        page = self.app.get_page(route)
+        rel_path = self.page_file(route)
+        if self.app.render_failed():
+            # Keep the previous file rather than one missing what could not be read
+            logging.warning(f"Not exporting {route}, some of its data could not be read")
+            return False
+
+        with self._lock:
+            if self._written.get(route, 0) > ticket:
+                # A render that started later was written meanwhile
+                return False
+            self._written[route] = ticket
+            if page is None:
+                # Entry no longer exists
+                if route in self.manifest["pages"]:
+                    self.remove_page(route)
+                    return True
+                return False
+
+            changed = self._write_atomic(rel_path, page.body)
+            if self.compress and (changed or not os.path.exists(os.path.join(self.out_dir, rel_path + ".gz"))):
+                # mtime=0 keeps the output identical for identical pages
+                self._write_atomic(rel_path + ".gz", gzip.compress(page.body, 9, mtime=0))
+            self.manifest["pages"][route] = {"file": rel_path, "etag": page.etag, "tags": sorted(page.tags, key=str)}
+            return changed
+
+    def save_manifest(self):
+        with self._lock:
+            data = json.dumps(self.manifest, indent=1, sort_keys=True).encode("utf-8")
+            self._write_atomic(MANIFEST_NAME, data)
+
+    def export_all(self):
+        """Export every page and drop files of entries that no longer exist."""
+        started = time.monotonic()
+        routes = self.routes()
+        written = sum(1 for route in routes if self.export_page(route))
+
+        with self._lock:
+            stale = set(self.manifest["pages"]) - set(routes)
+            for route in stale:
+                self.remove_page(route)
+            self.save_manifest()
+        logging.info(f"Exported {len(routes)} pages to {self.out_dir} ({written} changed, "
+                     f"{len(stale)} removed) in {time.monotonic() - started:.1f}s")
+        return written
+
+    def remove_page(self, route):
+        """Delete an exported page and its .gz sibling."""
+        with self._lock:
+            rel_path = self.manifest["pages"].pop(route)["file"]
+            for suffix in ("", ".gz"):
+                try:
+                    os.unlink(os.path.join(self.out_dir, rel_path + suffix))
+                except OSError:
+                    pass
+
+    def refresh(self, tags):
+        """Regenerate the exported pages that depend on any of the given tags.
+
+        Runs in the calling thread. A 'site_map' tag, which a folder title edit
+        adds, matches every exported page, so that refresh re-renders the whole
+        site; use refresh_later() to keep it out of a request.
+        """
+        tags = set(tags)
+        with self._lock:
+            routes = [route for route, info in self.manifest["pages"].items() if tags.intersection(info["tags"])]
+        written = sum(1 for route in routes if self.export_page(route))
+        if routes:
+            self.save_manifest()
+        logging.debug(f"Regenerated {written} of {len(routes)} affected static pages")
+        return written
+
+    def refresh_later(self, tags):
+        """Queue a refresh for a background thread. Tags queued while it runs are merged into its next pass."""
+        with self._pending_lock:
+            self._pending.update(tags)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._refresh_pending, name="static-export", daemon=True)
+                self._worker.start()
+
+    def _refresh_pending(self):
+        while True:
+            with self._pending_lock:
+                tags, self._pending = self._pending, set()
+                if not tags:
+                    self._worker = None
+                    return
+            try:
+                self.refresh(tags)
+            except Exception as e:
+                logging.error(f"Error regenerating static pages: {e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the trail pages to static HTML.")
+    parser.add_argument("db_path", help="SQLite database to export")
+    parser.add_argument("out_dir", help="directory to write the HTML files to")
+    parser.add_argument("--template-dir", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates"))
+    parser.add_argument("--no-gzip", action="store_true", help="do not write precompressed .gz files")
+    args = parser.parse_args()
+
+    from nlpapp import NLPApp
+    app = NLPApp(template_dir=args.template_dir, db_path=args.db_path)
+    exporter = StaticExporter(app, args.out_dir, compress=not args.no_gzip)
+    count = exporter.export_all()
+    print(f"Exported to {args.out_dir}, {count} pages changed.", file=sys.stderr)
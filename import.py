@@ -1,10 +1,179 @@
 import os
+import sys
+import time
 import sqlite3
 import mimetypes
 import re
+import argparse
+import codecs
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from striprtf.striprtf import rtf_to_text
 import chardet
 import logging
+from render_markdown import convert_markdown
+from migrations import migrate, child_position, schema_version, SCHEMA_VERSION
+from search import FTS_TABLE
+from media import media_task, media_stamp, missing_libraries
+
+RTF_BLOCK_SIZE = 64 * 1024
+# Imports redone on a fresh snapshot when the live database changes meanwhile
+SWAP_ATTEMPTS = 3
+ANSICPG = re.compile(rb"\\ansicpg(\d+)")
+# Below this chardet's guess from the first block is not trusted over the ANSI default
+CHARDET_MIN_CONFIDENCE = 0.5
+
+
+class BinaryGroupFilter:
+    """Drops embedded pictures and objects from RTF bytes fed in blocks.
+
+    Removes {\\pict ...}, {\\*\\objdata ...} and similar groups, and the raw data
+    of \\binN, none of which produce text. Only the remaining markup is kept, so
+    memory follows the length of the text rather than the size of the file.
+    Works on bytes: braces and backslashes are ASCII in every RTF encoding.
+    """
+
+    TOKEN = re.compile(rb"\\bin(?P<bin>\d+) ?"
+                       rb"|(?P<escape>\\[\\{}])"
+                       rb"|(?P<drop>\{\\(?:\*\\)?(?:pict|objdata|datastore|themedata)(?![a-z]))"
+                       rb"|(?P<brace>[{}])")
+    # Tokens starting this close to the end of a block wait for the next one
+    CARRY = 32
+
+    def __init__(self):
+        self.depth = 0
+        self.skip_depth = None  # depth of the group being dropped
+        self.skip_bytes = 0     # \bin data still to drop
+        self.carry = b""
+        self.kept = []
+
+    def feed(self, data, final=False):
+        data = self.carry + data
+        pos = min(self.skip_bytes, len(data))
+        self.skip_bytes -= pos
+        start = pos  # first byte not yet kept or dropped
+        limit = len(data) if final else len(data) - self.CARRY
+
+        while True:
+            m = self.TOKEN.search(data, pos)
+            if m is None or m.start() >= limit:
+                break
+            pos = m.end()
+            kind = m.lastgroup
+            if kind == "bin":
+                # \binN is followed by N raw bytes that may contain anything
+                if self.skip_depth is None:
+                    self.kept.append(data[start:m.start()])
+                pos += int(m.group("bin"))
+                if pos > len(data):
+                    self.skip_bytes = pos - len(data)
+                    pos = len(data)
+                start = pos
+            elif kind == "drop" or m.group(0) == b"{":
+                self.depth += 1
+                if kind == "drop" and self.skip_depth is None:
+                    self.kept.append(data[start:m.start()])
+                    self.skip_depth = self.depth
+            elif kind == "brace":
+                if self.skip_depth == self.depth:
+                    self.skip_depth = None
+                    start = pos
+                self.depth -= 1
+
+        end = len(data) if final else max(limit, pos)
+        if self.skip_depth is None:
+            self.kept.append(data[start:end])
+        self.carry = data[end:]
+
+    def text(self):
+        return b"".join(self.kept)
+
+
+def rtf_encoding(prefix):
+    """Encoding of an RTF file from its first bytes: \\ansicpg if declared, else chardet."""
+    match = ANSICPG.search(prefix)
+    if match:
+        encoding = f"cp{int(match.group(1))}"
+        try:
+            codecs.lookup(encoding)
+            return encoding
+        except LookupError:
+            pass
+    detected = chardet.detect(prefix)
+    # RTF without a declaration is ANSI, which in practice means Windows-1252. A prefix that
+    # looks ASCII is usually just the header, and would drop 8-bit text further on
+    encoding = detected.get("encoding")
+    if not encoding or encoding.lower() == "ascii" or (detected.get("confidence") or 0) < CHARDET_MIN_CONFIDENCE:
+        return "cp1252"
+    return encoding
+
+
+def decode_rtf(file_path, digest=None):
+    """Reads an RTF file and returns its plain text, or None on errors.
+
+    The file is read once, in blocks; the encoding is taken from the first
+    block and embedded pictures are dropped while reading. A hashlib object
+    passed as digest is fed the file's bytes on the way.
+    """
+    logging.info(f"Processing file: {file_path}")
+    try:
+        groups = BinaryGroupFilter()
+        with open(file_path, "rb") as f:
+            block = f.read(RTF_BLOCK_SIZE)
+            encoding = rtf_encoding(block)
+            logging.debug(f"Detected encoding for {file_path}: {encoding}")
+            while block:
+                if digest is not None:
+                    digest.update(block)
+                groups.feed(block)
+                block = f.read(RTF_BLOCK_SIZE)
+            groups.feed(b"", final=True)
+
+        content = rtf_to_text(groups.text().decode(encoding, errors="ignore"))
+        logging.info(f"Processed content from {file_path} successfully.")
+        return content
+
+    except Exception as e:
+        logging.error(f"Error processing {file_path}: {e}")
+        return None
+
+
+def file_digest(file_path):
+    """SHA-1 of a file's bytes, read in blocks."""
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def decode_rtf_with_html(file_path):
+    """Worker task: decoded text, its rendered Markdown and the file's content hash."""
+    digest = hashlib.sha1()
+    content = decode_rtf(file_path, digest)
+    return content, convert_markdown(content) if content else None, digest.hexdigest()
+
+
+def scan_folder(folder_path):
+    """Worker task: lists subfolders and importable files (name, size, mtime_ns) of one folder."""
+    subfolders, files = [], []
+    for item in os.listdir(folder_path):
+        item_path = os.path.join(folder_path, item)
+        if os.path.isdir(item_path):
+            subfolders.append(item_path)
+        elif os.path.isfile(item_path):
+            if item.endswith("titel.rtf") or item.startswith("."):
+                continue  # Skip title.rtf and hidden files
+            st = os.stat(item_path)
+            files.append((item, st.st_size, st.st_mtime_ns))
+    title_file = os.path.join(folder_path, "titel.rtf")
+    title_stat = None
+    if os.path.isfile(title_file):
+        st = os.stat(title_file)
+        title_stat = (st.st_size, st.st_mtime_ns)
+    return subfolders, files, title_stat
+
+
 
 class RTFImporter:
     def __init__(self, base_path, db_path):
@@ -20,25 +189,18 @@ class RTFImporter:
         match = re.match(r"^(\d+)[-_]", filename)
         return int(match.group(1)) if match else None
 
-    def process_file(self, file_path):
-        """Processes a single RTF file."""
-        logging.info(f"Processing file: {file_path}")
-        try:
-            with open(file_path, "rb") as f:
-                raw_data = f.read()
-                detected = chardet.detect(raw_data)
-                encoding = detected.get('encoding', 'utf-8')  # Default to UTF-8 if detection fails
-                logging.debug(f"Detected encoding for {file_path}: {encoding}")
-
-            with open(file_path, "r", encoding=encoding, errors='ignore') as f:
-                raw_text = f.read()
-                content = rtf_to_text(raw_text)
-                logging.info(f"Processed content from {file_path} successfully.")
-                return content
-
-        except Exception as e:
-            logging.error(f"Error processing {file_path}: {e}")
-            return None
+    def process_file(self, file_path, digest=None):
+        """Processes a single RTF file, feeding its bytes to digest if given."""
+        return decode_rtf(file_path, digest)
+
+    def source_path(self, path):
+        """Path of a file or folder relative to the import base path."""
+        return os.path.relpath(path, self.base_path)
+
+    def source_info(self, file_path, digest=None):
+        """(size, mtime_ns, content_hash) of a file; digest is the hash fed while decoding it."""
+        st = os.stat(file_path)
+        return st.st_size, st.st_mtime_ns, digest.hexdigest() if digest is not None else None
 
     def setup_database(self):
         """Sets up the SQLite database and tables."""
@@ -55,10 +217,25 @@ class RTFImporter:
             file_type TEXT, -- NULL for folders
             content TEXT, -- NULL for folders
             position_marker INTEGER, -- NULL for folders
+            content_html TEXT, -- content rendered from Markdown
+            source_path TEXT, -- relative to the import base path
+            source_size INTEGER,
+            source_mtime INTEGER,
+            content_hash TEXT,
+            level INTEGER, -- 0 for the root folder
+            path TEXT, -- ancestor ids, root first, e.g. '/1/3/'
+            media_width INTEGER, -- images
+            media_height INTEGER,
+            media_duration REAL, -- audio and video, in seconds
+            derivatives TEXT, -- JSON list of resized image copies
+            media_stamp TEXT,
             FOREIGN KEY (parent_id) REFERENCES file_entries (id)
         )
         """)
         conn.commit()
+        # Brings older databases up to date; also creates the search index triggers
+        # and navigation indexes, so they are maintained while rows are inserted
+        migrate(conn)
         conn.close()
         
         
@@ -70,32 +247,40 @@ class RTFImporter:
         cursor = conn.cursor()
         
         # Traverse directory and build hierarchy
-        folder_stack = [(None, self.base_path)]  # (parent_id, folder_path)
+        folder_stack = [(None, self.base_path, 0, "/")]  # (parent_id, folder_path, level, path)
         
         while folder_stack:
-            parent_id, folder_path = folder_stack.pop()
+            parent_id, folder_path, level, path = folder_stack.pop()
             folder_name = os.path.basename(folder_path)
             title = None
+            title_source = (None, None, None)
             
             # Process title.rtf if exists
             title_file = os.path.join(folder_path, "titel.rtf")
             logging.debug(f"testing for title: {title_file}")
             if os.path.isfile(title_file):
-                title = self.process_file(title_file)
+                digest = hashlib.sha1()
+                title = self.process_file(title_file, digest)
+                title_source = self.source_info(title_file, digest)
                 logging.debug(f"Processing folder title:{title_file}, {title}")
                 
             logging.debug(f"Processing folder: {folder_path}")
             # Insert folder entry
-            cursor.execute("INSERT INTO file_entries (parent_id, filename, entry_type, content) VALUES (?, ?, ?, ?)",
-                            (parent_id, folder_name, 'folder', title))
+            cursor.execute("""
+            INSERT INTO file_entries (parent_id, filename, entry_type, content, content_html, source_path, source_size, source_mtime, content_hash,
+                                      level, path)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (parent_id, folder_name, 'folder', title, convert_markdown(title) if title else None,
+                  self.source_path(folder_path)) + title_source + (level, path))
             folder_id = cursor.lastrowid
+            child_level, child_path = child_position(level, path, folder_id)
             
             try:
                 # Process files and subdirectories
                 for item in os.listdir(folder_path):
                     item_path = os.path.join(folder_path, item)
                     if os.path.isdir(item_path):
-                        folder_stack.append((folder_id, item_path))  # Queue subfolder
+                        folder_stack.append((folder_id, item_path, child_level, child_path))  # Queue subfolder
                     elif os.path.isfile(item_path):
                         if item.endswith("titel.rtf") or item.startswith("."):
                             continue  # Skip title.rtf and hidden files
@@ -103,15 +288,20 @@ class RTFImporter:
                         file_type, _ = mimetypes.guess_type(item_path)
                         position_marker = self.extract_position_marker(item)
                         content = None
+                        digest = None
                         
                         if item.endswith(".rtf"):
-                            content = self.process_file(item_path)
+                            digest = hashlib.sha1()
+                            content = self.process_file(item_path, digest)
                             
                         # Insert file entry
                         cursor.execute("""
-                        INSERT INTO file_entries (parent_id, filename, entry_type, file_type, content, position_marker)
-                        VALUES (?, ?, ?, ?, ?, ?)
-                        """, (folder_id, item, 'file', file_type, content, position_marker))
+                        INSERT INTO file_entries (parent_id, filename, entry_type, file_type, content, position_marker, content_html,
+                                                  source_path, source_size, source_mtime, content_hash, level, path)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        """, (folder_id, item, 'file', file_type, content, position_marker,
+                              convert_markdown(content) if content else None, self.source_path(item_path))
+                             + self.source_info(item_path, digest) + (child_level, child_path))
                 conn.commit()
             except Exception as e:
                 logging.error(f"Error processing folder {folder_path}: {e}")
@@ -120,12 +310,575 @@ class RTFImporter:
         conn.close()
         print("Import complete.")
 
-            
+    def import_parallel(self, workers=None, batch_size=1000, progress_interval=5.0):
+        """Imports the tree using a process pool for scanning and RTF decoding.
+
+        All rows go in through executemany batches inside a single transaction,
+        so readers never see a partially imported tree.
+        """
+        self.setup_database()
+
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        # Ids are assigned up front so children can be queued before their parent row is written
+        next_id = (cursor.execute("SELECT COALESCE(MAX(id), 0) FROM file_entries").fetchone()[0]) + 1
+
+        insert_sql = """
+        INSERT INTO file_entries (id, parent_id, filename, entry_type, file_type, content, position_marker, content_html,
+                                  source_path, source_size, source_mtime, content_hash, level, path)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """
+        rows = []
+        stats = {"folders": 0, "files": 0, "rtf": 0}
+        started = last_report = time.monotonic()
+
+        def flush():
+            if rows:
+                cursor.executemany(insert_sql, rows)
+                rows.clear()
+
+        def add_row(row):
+            rows.append(row)
+            if len(rows) >= batch_size:
+                flush()
+
+        pending = {}
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                root_id, next_id = next_id, next_id + 1
+                future = pool.submit(scan_folder, self.base_path)
+                pending[future] = ("scan", (root_id, None, self.base_path, 0, "/"))
+
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        kind, job = pending.pop(future)
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            logging.error(f"Error in import task {kind} {job}: {e}")
+                            result = None
+
+                        if kind == "scan":
+                            folder_id, parent_id, folder_path, level, path = job
+                            folder_name = os.path.basename(folder_path)
+                            stats["folders"] += 1
+                            folder_source = self.source_path(folder_path)
+                            if result is None:
+                                add_row((folder_id, parent_id, folder_name, 'folder', None, None, None, None, folder_source, None, None, None,
+                                         level, path))
+                                continue
+                            subfolders, files, title_stat = result
+                            child_level, child_path = child_position(level, path, folder_id)
+
+                            if title_stat:
+                                title_future = pool.submit(decode_rtf_with_html, os.path.join(folder_path, "titel.rtf"))
+                                pending[title_future] = ("folder", (folder_id, parent_id, folder_name, folder_source, level, path) + title_stat)
+                            else:
+                                add_row((folder_id, parent_id, folder_name, 'folder', None, None, None, None, folder_source, None, None, None,
+                                         level, path))
+
+                            for subfolder_path in subfolders:
+                                scan_future = pool.submit(scan_folder, subfolder_path)
+                                pending[scan_future] = ("scan", (next_id, folder_id, subfolder_path, child_level, child_path))
+                                next_id += 1
+
+                            for item, size, mtime in files:
+                                item_path = os.path.join(folder_path, item)
+                                file_type, _ = mimetypes.guess_type(item_path)
+                                file_row = (next_id, folder_id, item, 'file', file_type, None, self.extract_position_marker(item), None,
+                                            self.source_path(item_path), size, mtime, None, child_level, child_path)
+                                next_id += 1
+                                if item.endswith(".rtf"):
+                                    pending[pool.submit(decode_rtf_with_html, item_path)] = ("file", file_row)
+                                else:
+                                    stats["files"] += 1
+                                    add_row(file_row)
+
+                        elif kind == "folder":
+                            folder_id, parent_id, folder_name, folder_source, level, path, size, mtime = job
+                            title, title_html, digest = result or (None, None, None)
+                            add_row((folder_id, parent_id, folder_name, 'folder', None, title, None, title_html,
+                                     folder_source, size, mtime, digest, level, path))
+
+                        else:
+                            content, content_html, digest = result or (None, None, None)
+                            stats["files"] += 1
+                            stats["rtf"] += 1
+                            add_row(job[:5] + (content, job[6], content_html) + job[8:11] + (digest,) + job[12:])
+
+                    now = time.monotonic()
+                    if now - last_report >= progress_interval:
+                        last_report = now
+                        self.report_progress(stats, now - started, len(pending))
+
+            flush()
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        elapsed = time.monotonic() - started
+        self.report_progress(stats, elapsed, 0)
+        print("Import complete.")
+        return stats
+
+    def sync_to_sqlite(self):
+        """Brings the database in line with the folder tree, touching only what changed.
+
+        Rows are matched by source path so existing ids (and the links and QR codes
+        pointing at them) survive. Unchanged files are recognised by size and mtime,
+        RTFs whose bytes hash the same are not decoded again, and rows whose file or
+        folder vanished are deleted. Runs in a single transaction.
+        """
+        self.setup_database()
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        stats = {"added": 0, "updated": 0, "unchanged": 0, "deleted": 0}
+        started = time.monotonic()
+
+        try:
+            existing, duplicates = self.load_existing_rows(cursor)
+            seen = set()
+
+            def decoded(file_path, digest=None):
+                content = self.process_file(file_path, digest)
+                return content, convert_markdown(content) if content else None
+
+            folder_stack = [(None, self.base_path, 0, "/")]  # (parent_id, folder_path, level, path)
+            while folder_stack:
+                parent_id, folder_path, level, path = folder_stack.pop()
+                rel_path = self.source_path(folder_path)
+                row = existing.get(rel_path)
+                if row is not None and row["entry_type"] != "folder":
+                    row = None  # a file was replaced by a folder of the same name
+
+                title_file = os.path.join(folder_path, "titel.rtf")
+                title_stat = os.stat(title_file) if os.path.isfile(title_file) else None
+                source = (title_stat.st_size, title_stat.st_mtime_ns) if title_stat else (None, None)
+
+                if row is None:
+                    title, title_html, digest = None, None, None
+                    if title_stat:
+                        title_digest = hashlib.sha1()
+                        title, title_html = decoded(title_file, title_digest)
+                        digest = title_digest.hexdigest()
+                    cursor.execute("""
+                    INSERT INTO file_entries (parent_id, filename, entry_type, content, content_html, source_path, source_size, source_mtime, content_hash,
+                                              level, path)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """, (parent_id, os.path.basename(folder_path), 'folder', title, title_html, rel_path) + source + (digest, level, path))
+                    folder_id = cursor.lastrowid
+                    stats["added"] += 1
+                else:
+                    folder_id = row["id"]
+                    self.sync_row(cursor, row, title_file if title_stat else None, source, decoded, stats, position=(level, path))
+                seen.add(folder_id)
+                child_level, child_path = child_position(level, path, folder_id)
+
+                try:
+                    items = os.listdir(folder_path)
+                except OSError as e:
+                    logging.error(f"Error processing folder {folder_path}: {e}")
+                    # Keep what we know about the folder's contents rather than deleting it
+                    prefix = "" if rel_path == "." else rel_path + os.sep
+                    seen.update(r["id"] for p, r in existing.items() if p.startswith(prefix))
+                    continue
+
+                for item in items:
+                    item_path = os.path.join(folder_path, item)
+                    if os.path.isdir(item_path):
+                        folder_stack.append((folder_id, item_path, child_level, child_path))
+                        continue
+                    if not os.path.isfile(item_path) or item.endswith("titel.rtf") or item.startswith("."):
+                        continue
+
+                    rel_item = self.source_path(item_path)
+                    st = os.stat(item_path)
+                    source = (st.st_size, st.st_mtime_ns)
+                    file_type, _ = mimetypes.guess_type(item_path)
+                    row = existing.get(rel_item)
+                    if row is not None and (row["entry_type"] != "file" or row["parent_id"] != folder_id):
+                        row = None
+
+                    if row is None:
+                        content, content_html, digest = None, None, None
+                        if item.endswith(".rtf"):
+                            item_digest = hashlib.sha1()
+                            content, content_html = decoded(item_path, item_digest)
+                            digest = item_digest.hexdigest()
+                        cursor.execute("""
+                        INSERT INTO file_entries (parent_id, filename, entry_type, file_type, content, position_marker, content_html,
+                                                  source_path, source_size, source_mtime, content_hash, level, path)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        """, (folder_id, item, 'file', file_type, content, self.extract_position_marker(item), content_html,
+                              rel_item) + source + (digest, child_level, child_path))
+                        seen.add(cursor.lastrowid)
+                        stats["added"] += 1
+                    else:
+                        seen.add(row["id"])
+                        self.sync_row(cursor, row, item_path if item.endswith(".rtf") else None, source, decoded, stats,
+                                      file_type=file_type, position=(child_level, child_path))
+
+            vanished = [row["id"] for row in existing.values() if row["id"] not in seen] + duplicates
+            for start in range(0, len(vanished), 500):
+                chunk = vanished[start:start + 500]
+                cursor.execute(f"DELETE FROM file_entries WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+            stats["deleted"] = len(vanished)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        message = (f"Sync: {stats['added']} added, {stats['updated']} updated, {stats['unchanged']} unchanged, "
+                   f"{stats['deleted']} deleted in {time.monotonic() - started:.1f}s")
+        logging.info(message)
+        print(message)
+        return stats
+
+    def load_existing_rows(self, cursor):
+        """Rows of this trail keyed by source path, plus ids of duplicated rows to remove.
+
+        Source paths are backfilled from the parent chain for databases imported
+        before syncs existed.
+        """
+        root_name = os.path.basename(self.base_path)
+        roots = [r[0] for r in cursor.execute(
+                "SELECT id FROM file_entries WHERE parent_id IS NULL AND filename = ? ORDER BY id", (root_name,))]
+        if not roots:
+            return {}, []
+
+        # Earlier full imports appended a copy of the tree on every run; keep the oldest
+        duplicates = []
+        for dup_root in roots[1:]:
+            duplicates += [r[0] for r in cursor.execute("""
+                    WITH RECURSIVE subtree(id) AS (
+                            SELECT ? UNION ALL
+                            SELECT f.id FROM file_entries f JOIN subtree s ON f.parent_id = s.id
+                    ) SELECT id FROM subtree""", (dup_root,))]
+
+        cursor.execute("""
+                WITH RECURSIVE subtree(id) AS (
+                        SELECT ? UNION ALL
+                        SELECT f.id FROM file_entries f JOIN subtree s ON f.parent_id = s.id
+                )
+                SELECT f.id, f.parent_id, f.filename, f.entry_type, f.file_type, f.source_path, f.source_size, f.source_mtime, f.content_hash,
+                       f.level, f.path
+                FROM file_entries f JOIN subtree USING (id)
+                ORDER BY f.id
+        """, (roots[0],))
+        columns = [d[0] for d in cursor.description]
+        rows = {r[0]: dict(zip(columns, r)) for r in cursor.fetchall()}
+
+        def rel_path(row):
+            if row["source_path"] is None:
+                row["legacy"] = True
+                parent = rows.get(row["parent_id"])
+                row["source_path"] = "." if parent is None else os.path.normpath(os.path.join(rel_path(parent), row["filename"]))
+            return row["source_path"]
+
+        existing = {}
+        for row in rows.values():
+            path = rel_path(row)
+            if path in existing:
+                duplicates.append(row["id"])  # same path twice inside one tree: keep the older row
+            else:
+                existing[path] = row
+        if duplicates:
+            logging.info(f"Removing {len(duplicates)} duplicated rows of {root_name}")
+        return existing, duplicates
+
+    def sync_row(self, cursor, row, rtf_path, source, decoded, stats, file_type=None, position=None):
+        """Updates one existing row if its source file or its (level, path) changed."""
+        moved = position is not None and (row["level"], row["path"]) != position
+        if (row["source_size"], row["source_mtime"]) == source and not row.get("legacy"):
+            if moved:
+                cursor.execute("UPDATE file_entries SET level = ?, path = ? WHERE id = ?", position + (row["id"],))
+            stats["unchanged"] += 1
+            return
+
+        updates = {"source_path": row["source_path"], "source_size": source[0], "source_mtime": source[1]}
+        if moved:
+            updates["level"], updates["path"] = position
+        if file_type is not None and file_type != row["file_type"]:
+            updates["file_type"] = file_type
+        if rtf_path is not None:
+            digest = file_digest(rtf_path)
+            if digest != row["content_hash"]:
+                updates["content"], updates["content_html"] = decoded(rtf_path)
+                updates["content_hash"] = digest
+        elif row["entry_type"] == "folder" and row["content_hash"] is not None:
+            # titel.rtf was removed
+            updates.update(content=None, content_html=None, content_hash=None)
+
+        assignments = ", ".join(f"{name} = ?" for name in updates)
+        cursor.execute(f"UPDATE file_entries SET {assignments} WHERE id = ?", list(updates.values()) + [row["id"]])
+        stats["updated"] += 1
+
+    def process_media(self, workers=None, derivatives_dir=None, batch_size=500):
+        """Stores dimensions and durations of media files and writes resized image copies.
+
+        Runs in a process pool after an import. Files whose size and mtime match
+        the stored media_stamp are skipped, unless derivatives are requested
+        and the row has none yet.
+        """
+        missing = missing_libraries()
+        if missing:
+            logging.warning(f"Media metadata is incomplete without {', '.join(missing)}")
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        stats = {"processed": 0, "unchanged": 0}
+        try:
+            rows = cursor.execute("""
+                    SELECT id, source_path, file_type, source_size, source_mtime, media_stamp, derivatives
+                    FROM file_entries
+                    WHERE entry_type = 'file' AND source_path IS NOT NULL
+                      AND (file_type LIKE 'image/%' OR file_type LIKE 'audio/%' OR file_type LIKE 'video/%')
+            """).fetchall()
+            todo = []
+            for id_, source_path, file_type, size, mtime, stamp, derivatives in rows:
+                wants_derivatives = derivatives_dir and file_type.startswith("image/") and derivatives is None
+                if stamp == media_stamp(size, mtime) and not wants_derivatives:
+                    stats["unchanged"] += 1
+                else:
+                    todo.append((id_, source_path, file_type, media_stamp(size, mtime)))
+
+            update_sql = """
+                    UPDATE file_entries SET media_width = ?, media_height = ?, media_duration = ?, derivatives = ?, media_stamp = ?
+                    WHERE id = ?
+            """
+            updates = []
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(media_task, os.path.join(self.base_path, source_path), source_path, file_type,
+                                       derivatives_dir): (id_, stamp)
+                           for id_, source_path, file_type, stamp in todo}
+                for future in futures:
+                    id_, stamp = futures[future]
+                    info = future.result()
+                    updates.append((info["width"], info["height"], info["duration"], info["derivatives"],
+                                    stamp if info["complete"] else None, id_))
+                    stats["processed"] += 1
+                    if len(updates) >= batch_size:
+                        cursor.executemany(update_sql, updates)
+                        updates.clear()
+            cursor.executemany(update_sql, updates)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        message = f"Media: {stats['processed']} files processed, {stats['unchanged']} unchanged"
+        logging.info(message)
+        print(message)
+        return stats
+
+    def swap_import(self, build, *args, **kwargs):
+        """Runs an import method on a copy of the database and swaps the copy in if it is valid.
+
+        The copy starts as a snapshot of the live database, so ids and other trees
+        survive as they would in place. The app keeps serving the old data until
+        install_database() puts the new data in place. If anything was saved in
+        the live database while the import ran, the import is redone on a new
+        snapshot, up to SWAP_ATTEMPTS times.
+        """
+        live_path = self.db_path
+        build_path = f"{live_path}.import-{os.getpid()}"
+        for attempt in range(1, SWAP_ATTEMPTS + 1):
+            self.remove_database(build_path)
+            live, state = None, None
+            if os.path.exists(live_path):
+                # Kept open until the swap: its data_version tells whether anyone else wrote meanwhile
+                live = sqlite3.connect(live_path, timeout=30)
+                state = self.live_state(live, live_path)
+                target = sqlite3.connect(build_path)
+                try:
+                    live.backup(target)
+                finally:
+                    target.close()
+
+            self.db_path = build_path
+            try:
+                result = build(*args, **kwargs)
+                self.validate_database(build_path)
+
+                conn = sqlite3.connect(build_path)
+                try:
+                    # A single self-contained file, which read-only (immutable) servers require
+                    conn.execute("PRAGMA journal_mode=DELETE")
+                finally:
+                    conn.close()
+                with open(build_path, "rb") as f:
+                    os.fsync(f.fileno())
+
+                self.db_path = live_path
+                if self.install_database(build_path, live, state):
+                    break
+            except Exception:
+                self.remove_database(build_path)
+                raise
+            finally:
+                self.db_path = live_path
+                if live is not None:
+                    live.close()
+            logging.warning(f"{live_path} was changed while importing, starting over (attempt {attempt} of {SWAP_ATTEMPTS})")
+        else:
+            self.remove_database(build_path)
+            raise RuntimeError(f"{live_path} kept changing during the import; nothing was swapped in")
+
+        logging.info(f"Swapped the new database in at {live_path}")
+        print(f"Swapped the new database in at {live_path}")
+        return result
+
+    def live_state(self, conn, db_path):
+        """What changes when the live database is written to or replaced: data_version and the file's inode."""
+        st = os.stat(db_path)
+        return conn.execute("PRAGMA data_version").fetchone()[0], (st.st_dev, st.st_ino)
+
+    def install_database(self, build_path, live, state):
+        """Puts the database at build_path in place of the live one. Returns False, and leaves the
+        live one alone, if it changed since state was taken.
+
+        The check and the install happen under the live database's write lock,
+        so a save cannot slip in between. A live database in WAL mode is being
+        served by a writable app, whose connections would share the -wal and
+        -shm files with a new file under the same name; its rows are replaced
+        in one transaction instead (see copy_database). Other databases, which
+        read-only servers require, are swapped by renaming.
+        """
+        live_path = self.db_path
+        if live is None:
+            self.replace_database(build_path, live_path)
+            return True
+
+        in_place = live.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        if in_place:
+            # Only writes if the live schema is older; our own commits leave data_version alone
+            migrate(live)
+            live.execute("ATTACH DATABASE ? AS build", (build_path,))
+        try:
+            live.execute("BEGIN IMMEDIATE")
+            try:
+                if self.live_state(live, live_path) != state:
+                    return False
+                # Switching journal modes needs the lock we now hold, so this stays true until we are done
+                if (live.execute("PRAGMA journal_mode").fetchone()[0] == "wal") != in_place:
+                    return False
+                if in_place:
+                    self.copy_database(live)
+                    live.commit()
+                else:
+                    self.replace_database(build_path, live_path)
+                return True
+            finally:
+                if live.in_transaction:
+                    live.rollback()
+        finally:
+            if in_place:
+                live.execute("DETACH DATABASE build")
+                self.remove_database(build_path)
+
+    def copy_database(self, conn):
+        """Replaces the rows of file_entries with those of the attached build database.
+
+        Runs in conn's open transaction, so readers see the old rows until it
+        commits. The search index follows through its triggers.
+        """
+        columns = ", ".join(row[1] for row in conn.execute("PRAGMA build.table_info(file_entries)"))
+        conn.execute("DELETE FROM main.file_entries")
+        conn.execute(f"INSERT INTO main.file_entries ({columns}) SELECT {columns} FROM build.file_entries")
+
+    def replace_database(self, build_path, live_path):
+        """Renames build_path over live_path and makes the rename durable."""
+        os.replace(build_path, live_path)
+        dir_fd = os.open(os.path.dirname(os.path.abspath(live_path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def remove_database(self, db_path):
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+
+    def validate_database(self, db_path):
+        """Raises ValueError if a freshly built database is not fit to be served."""
+        conn = sqlite3.connect(db_path)
+        try:
+            problems = []
+            check = conn.execute("PRAGMA quick_check").fetchone()[0]
+            if check != "ok":
+                problems.append(f"quick_check: {check}")
+            if schema_version(conn) != SCHEMA_VERSION:
+                problems.append(f"schema version {schema_version(conn)}, expected {SCHEMA_VERSION}")
+            if not conn.execute("SELECT 1 FROM file_entries WHERE parent_id IS NULL LIMIT 1").fetchone():
+                problems.append("no root entry")
+            orphans = conn.execute("""
+                    SELECT COUNT(*) FROM file_entries f
+                    WHERE f.parent_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM file_entries p WHERE p.id = f.parent_id)
+            """).fetchone()[0]
+            if orphans:
+                problems.append(f"{orphans} entries without a parent")
+            unplaced = conn.execute("SELECT COUNT(*) FROM file_entries WHERE level IS NULL OR path IS NULL").fetchone()[0]
+            if unplaced:
+                problems.append(f"{unplaced} entries without level or path")
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (FTS_TABLE,)).fetchone():
+                try:
+                    conn.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('integrity-check')")
+                except sqlite3.DatabaseError as e:
+                    problems.append(f"search index: {e}")
+            if problems:
+                raise ValueError(f"Not swapping in {db_path}: " + "; ".join(problems))
+        finally:
+            conn.close()
+
+    def report_progress(self, stats, elapsed, pending):
+        """Prints and logs import progress and throughput."""
+        rate = stats["files"] / elapsed if elapsed > 0 else 0.0
+        message = (f"{stats['folders']} folders, {stats['files']} files ({stats['rtf']} RTF) "
+                   f"in {elapsed:.1f}s, {rate:.1f} files/s, {pending} tasks pending")
+        logging.info(message)
+        print(message, file=sys.stderr)
+
+
 # Example usage
 if __name__ == "__main__":
-    base_path = "./"  # Replace with the actual path to your files
-    db_path = "data_import.sqlite"
+    parser = argparse.ArgumentParser(description="Import a folder tree of RTF and media files into SQLite.")
+    parser.add_argument("base_path", nargs="?", default="./", help="root folder of the trail files")
+    parser.add_argument("db_path", nargs="?", default="data_import.sqlite", help="SQLite database to write")
+    parser.add_argument("--parallel", action="store_true", help="scan and decode with a process pool in one transaction")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: CPU count)")
+    parser.add_argument("--sync", action="store_true", help="update an existing import, keeping entry ids")
+    parser.add_argument("--in-place", action="store_true",
+                        help="write into db_path directly instead of building a copy and swapping it in")
+    parser.add_argument("--media", action="store_true",
+                        help="store image sizes and audio/video durations (needs Pillow and mutagen)")
+    parser.add_argument("--derivatives", default=None, metavar="DIR",
+                        help="also write resized image copies for srcset to DIR (implies --media)")
+    args = parser.parse_args()
+
+    importer = RTFImporter(args.base_path, args.db_path)
+    if args.sync:
+        build, options = importer.sync_to_sqlite, {}
+    elif args.parallel:
+        build, options = importer.import_parallel, {"workers": args.workers}
+    else:
+        build, options = importer.import_to_sqlite, {}
+    if args.media or args.derivatives:
+        import_files = build
 
-    importer = RTFImporter(base_path, db_path)
-    importer.import_to_sqlite()
+        def build(**options):
+            result = import_files(**options)
+            importer.process_media(workers=args.workers, derivatives_dir=args.derivatives)
+            return result
+    if args.in_place:
+        build(**options)
+    else:
+        importer.swap_import(build, **options)
     
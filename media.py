@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# media metadata (dimensions, duration) and resized image derivatives for the importer
+import os
+import json
+import logging
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # optional, images then get no dimensions or derivatives
+    Image = None
+
+try:
+    import mutagen
+except ImportError:  # optional, audio and video then get no duration
+    mutagen = None
+
+# Widths of the resized copies offered in srcset; the smallest doubles as thumbnail
+DERIVATIVE_WIDTHS = (160, 480, 960, 1600)
+JPEG_QUALITY = 82
+
+# EXIF orientations that swap width and height
+_ROTATED = {5, 6, 7, 8}
+
+
+def media_stamp(size, mtime):
+    """Marks the version of a source file whose metadata is stored."""
+    return f"{size}:{mtime}"
+
+
+def derivative_path(source_path, width, alpha=False):
+    """Path of a derivative relative to the derivatives directory."""
+    return f"{source_path}.{width}.{'png' if alpha else 'jpg'}"
+
+
+def image_info(file_path):
+    """(width, height) of an image as displayed, i.e. after EXIF rotation."""
+    with Image.open(file_path) as img:
+        width, height = img.size
+        if img.getexif().get(0x0112) in _ROTATED:
+            width, height = height, width
+    return width, height
+
+
+def make_derivatives(file_path, source_path, derivatives_dir, widths=DERIVATIVE_WIDTHS):
+    """Writes the resized copies of an image that are narrower than it. Returns [(width, relative path)].
+
+    Copies that are newer than the source are kept as they are.
+    """
+    source_mtime = os.stat(file_path).st_mtime_ns
+    derivatives = []
+    img = None
+    try:
+        for width in widths:
+            if img is None:
+                img = ImageOps.exif_transpose(Image.open(file_path))
+                alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+            if width >= img.width:
+                break
+            rel_path = derivative_path(source_path, width, alpha)
+            out_path = os.path.join(derivatives_dir, rel_path)
+            derivatives.append((width, rel_path))
+            if os.path.exists(out_path) and os.stat(out_path).st_mtime_ns >= source_mtime:
+                continue
+
+            copy = img.copy()
+            copy.thumbnail((width, img.height), Image.LANCZOS)
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            tmp_path = out_path + ".tmp"
+            if alpha:
+                copy.save(tmp_path, "PNG", optimize=True)
+            else:
+                copy.convert("RGB").save(tmp_path, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+            os.replace(tmp_path, out_path)
+    finally:
+        if img is not None:
+            img.close()
+    return derivatives
+
+
+def media_task(file_path, source_path, file_type, derivatives_dir=None):
+    """Worker task: metadata of one media file as a dictionary, plus derivatives for images.
+
+    "complete" is False when the library for the file type is missing, so the
+    file is looked at again once it is installed.
+    """
+    is_image = file_type.startswith("image/")
+    info = {"width": None, "height": None, "duration": None, "derivatives": None,
+            "complete": (Image if is_image else mutagen) is not None}
+    if is_image and derivatives_dir and Image is not None:
+        # Also recorded for unreadable images, so they are not retried on every run
+        info["derivatives"] = "[]"
+    try:
+        if is_image and Image is not None:
+            info["width"], info["height"] = image_info(file_path)
+            if derivatives_dir:
+                info["derivatives"] = json.dumps(make_derivatives(file_path, source_path, derivatives_dir))
+        elif file_type.startswith(("audio/", "video/")) and mutagen is not None:
+            parsed = mutagen.File(file_path)
+            if parsed is not None and getattr(parsed, "info", None) is not None:
+                info["duration"] = getattr(parsed.info, "length", None)
+    except Exception as e:
+        logging.warning(f"Could not read media file {file_path}: {e}")
+    return info
+
+
+def missing_libraries():
+    """Names of the optional libraries that are not installed."""
+    return [name for name, module in (("Pillow", Image), ("mutagen", mutagen)) if module is None]
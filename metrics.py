@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# per-request phase timing, Server-Timing headers and Prometheus metrics
+import time
+import random
+import logging
+import threading
+from functools import wraps
+
+# Upper bounds in seconds, shared by the request and phase histograms
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+_current = threading.local()
+
+
+class RequestTimer:
+    """Accumulates the time spent in named phases while one request is handled."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        """Server-Timing header value, durations in milliseconds."""
+        parts = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.phases.items()]
+        parts.append(f"total;dur={self.elapsed() * 1000:.2f}")
+        return ", ".join(parts)
+
+
+def start_request(sample_rate=1.0):
+    """Begin timing a request on this thread and decide whether its DEBUG logs are kept."""
+    _current.timer = RequestTimer()
+    _current.log_sampled = sample_rate >= 1.0 or random.random() < sample_rate
+    return _current.timer
+
+
+def end_request():
+    _current.timer = None
+    _current.log_sampled = True
+
+
+class FinishedBody:
+    """Wraps a WSGI response body that is produced while the server iterates it.
+
+    on_close runs once the server has closed it, sent or abandoned, so
+    the request's timings include the work done in the body.
+    """
+
+    def __init__(self, iterable, on_close):
+        self.iterable = iterable
+        self.on_close = on_close
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, "close"):
+                self.iterable.close()
+        finally:
+            self.on_close()
+
+
+def current_timer():
+    return getattr(_current, "timer", None)
+
+
+class phase:
+    """Context manager timing a block as a phase of the current request."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        timer = current_timer()
+        if timer is not None:
+            timer.add(self.name, time.perf_counter() - self.started)
+        return False
+
+
+def timed(name):
+    """Decorator timing every call of a function as a phase of the current request."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            timer = current_timer()
+            if timer is None:
+                return func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timer.add(name, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+class SampledDebugFilter(logging.Filter):
+    """Drops DEBUG records of requests that were not picked for debug logging."""
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or getattr(_current, "log_sampled", True)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += value
+        self.count += 1
+
+
+def _labels(labels):
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}" if labels else ""
+
+
+class Metrics:
+    """Counters and latency histograms of one worker process, rendered in Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}    # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.help = {}
+
+    def inc(self, name, labels=(), value=1, help=None):
+        key = (name, tuple(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            if help:
+                self.help.setdefault(name, help)
+
+    def observe(self, name, value, labels=(), help=None):
+        key = (name, tuple(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+            if help:
+                self.help.setdefault(name, help)
+
+    def record_request(self, route, status, timer):
+        """Feed one finished request into the counters and histograms."""
+        self.inc("nlpapp_requests_total", (("route", route), ("status", status.split(" ", 1)[0])),
+                 help="Requests handled, by route and status code.")
+        self.observe("nlpapp_request_duration_seconds", timer.elapsed(), (("route", route),),
+                     help="Request handling time, by route.")
+        for name, seconds in timer.phases.items():
+            self.observe("nlpapp_phase_duration_seconds", seconds, (("phase", name),),
+                         help="Time spent per request in each phase.")
+
+    def render(self):
+        lines = []
+        seen = set()
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in seen:
+                    seen.add(name)
+                    lines.append(f"# HELP {name} {self.help.get(name, name)}")
+                    lines.append(f"# TYPE {name} counter")
+                lines.append(f"{name}{_labels(labels)} {value}")
+
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in seen:
+                    seen.add(name)
+                    lines.append(f"# HELP {name} {self.help.get(name, name)}")
+                    lines.append(f"# TYPE {name} histogram")
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {histogram.total:.6f}")
+                lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# versioned schema migrations for file_entries, tracked in PRAGMA user_version
+import sys
+import logging
+import sqlite3
+import argparse
+
+from render_markdown import ensure_html_column
+from search import ensure_search_index
+
+# Where each row came from, so a sync can tell changed files from unchanged ones
+SYNC_COLUMNS = [("source_path", "TEXT"),      # relative to base_path, '.' for the root folder
+                ("source_size", "INTEGER"),   # of the file, or of titel.rtf for folders
+                ("source_mtime", "INTEGER"),  # st_mtime_ns
+                ("content_hash", "TEXT")]     # SHA-1 of RTF files
+
+# Depth and ancestry of a row; path lists the ancestor ids root first, e.g. '/1/3/', and is '/' for roots
+TREE_COLUMNS = [("level", "INTEGER"),
+                ("path", "TEXT")]
+
+# Filled by the importer's media pass; the byte size is source_size
+MEDIA_COLUMNS = [("media_width", "INTEGER"),   # images, as displayed
+                 ("media_height", "INTEGER"),
+                 ("media_duration", "REAL"),   # audio and video, in seconds
+                 ("derivatives", "TEXT"),      # JSON [[width, path relative to the derivatives directory], ...]
+                 ("media_stamp", "TEXT")]      # source size and mtime the above were read from
+
+
+def child_position(level, path, parent_id):
+    """(level, path) of a child of the row at level/path with id parent_id."""
+    return level + 1, f"{path}{parent_id}/"
+
+
+def path_ids(path):
+    """Ancestor ids stored in a path, root first."""
+    return [int(part) for part in path.split("/") if part]
+
+
+def _columns(conn):
+    return [row[1] for row in conn.execute("PRAGMA table_info(file_entries)")]
+
+
+def _add_columns(conn, columns):
+    existing = _columns(conn)
+    for name, sql_type in columns:
+        if name not in existing:
+            conn.execute(f"ALTER TABLE file_entries ADD COLUMN {name} {sql_type}")
+
+
+def add_sync_columns(conn):
+    _add_columns(conn, SYNC_COLUMNS)
+
+
+def add_search_index(conn):
+    if not ensure_search_index(conn):
+        logging.warning("Full-text search is unavailable in this database")
+
+
+def add_tree_columns(conn):
+    """Add level and path and fill them for existing rows, top down."""
+    _add_columns(conn, TREE_COLUMNS)
+    rows = conn.execute("SELECT id, parent_id FROM file_entries").fetchall()
+    children = {}
+    for id_, parent_id in rows:
+        children.setdefault(parent_id, []).append(id_)
+    known = {id_ for id_, _ in rows}
+
+    # Rows whose parent is missing are treated as roots, like the tree index does
+    stack = [(id_, 0, "/") for id_, parent_id in rows if parent_id is None or parent_id not in known]
+    updates = []
+    while stack:
+        id_, level, path = stack.pop()
+        updates.append((level, path, id_))
+        child_level, child_path = child_position(level, path, id_)
+        stack.extend((child, child_level, child_path) for child in children.get(id_, ()))
+    conn.executemany("UPDATE file_entries SET level = ?, path = ? WHERE id = ?", updates)
+
+
+def add_navigation_indexes(conn):
+    # Sibling folders and top-level entries: parent_id = ? AND entry_type = ? ORDER BY position_marker
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_file_entries_nav ON file_entries (parent_id, entry_type, position_marker)")
+    # All children of a folder in page order
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_file_entries_children ON file_entries (parent_id, position_marker)")
+
+
+def add_media_columns(conn):
+    _add_columns(conn, MEDIA_COLUMNS)
+
+
+# (version, description, step); steps are idempotent, so an interrupted one is simply run again
+MIGRATIONS = [
+        (1, "content_html column", ensure_html_column),
+        (2, "source tracking columns", add_sync_columns),
+        (3, "full-text search index", add_search_index),
+        (4, "level and path columns", add_tree_columns),
+        (5, "navigation indexes", add_navigation_indexes),
+        (6, "media metadata columns", add_media_columns),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn, target=SCHEMA_VERSION):
+    """Apply the pending migrations up to target. Returns the versions applied."""
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'file_entries'").fetchone():
+        return []
+    applied = []
+    for version, description, step in MIGRATIONS:
+        if version > target or version <= schema_version(conn):
+            continue
+        logging.info(f"Migrating database to version {version}: {description}")
+        try:
+            step(conn)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append(version)
+    return applied
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bring a file_entries database up to the current schema.")
+    parser.add_argument("db_path")
+    parser.add_argument("--status", action="store_true", help="only print the schema version and pending migrations")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+    conn = sqlite3.connect(args.db_path)
+    try:
+        current = schema_version(conn)
+        if args.status:
+            print(f"Schema version {current} of {SCHEMA_VERSION}")
+            for version, description, _ in MIGRATIONS:
+                if version > current:
+                    print(f"  pending {version}: {description}")
+            sys.exit(0)
+        applied = migrate(conn)
+        print(f"Applied {len(applied)} migrations, schema version {schema_version(conn)}")
+    finally:
+        conn.close()
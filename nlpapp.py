@@ -2,44 +2,212 @@
 # app server with updated sql schema for navigation
 import os, sys, io
 import logging
-import sqlite3
-from jinja2 import Environment, FileSystemLoader
-import markdown
-from urllib.parse import urlparse, parse_qs, unquote
+import threading
+import zlib
+import json
+import time
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+from urllib.parse import parse_qs, unquote, urlencode, quote
+from tree_index import TreeIndex, build_site_map
+from render_markdown import convert_markdown
+from migrations import migrate, path_ids, schema_version, SCHEMA_VERSION
+from page_cache import CachedPage, PageCache, MIN_COMPRESS_SIZE, available_encodings, negotiate_encoding
+from db import ConnectionManager
+from static_files import serve_file
+from search import search_entries
+from metrics import Metrics, FinishedBody, SampledDebugFilter, phase, timed, start_request, end_request
 #from wsgiref.simple_server import make_server
 
 EDIT_MODE = True
+# DEBUG records are kept for this fraction of requests only
+LOG_SAMPLE_RATE = float(os.environ.get('NLPAPP_LOG_SAMPLE', '0.01'))
+# Streamed pages are sent in chunks of about this size, and whenever the template passes the marker
+STREAM_CHUNK_SIZE = 8192
+STREAM_FLUSH_MARKER = '<!-- flush -->'
+# Set NLPAPP_COMPRESS=0 when a front-end proxy (e.g. mod_deflate) already compresses responses
+COMPRESS_PAGES = os.environ.get('NLPAPP_COMPRESS', '1') != '0'
+# Public deployments without editing: NLPAPP_READ_ONLY=1 serves an immutable database and disables /edit/ and /save
+READ_ONLY = os.environ.get('NLPAPP_READ_ONLY', '0') == '1'
+
+# How the children of a folder are grouped on its page, as SQL conditions
+_MEDIA = "(file_type LIKE 'image/%' OR file_type LIKE 'audio/%' OR file_type LIKE 'video/%')"
+CHILD_CATEGORIES = {
+        "folders": "entry_type = 'folder'",  # Subfolders
+        "images": "entry_type != 'folder' AND file_type LIKE 'image/%'",
+        "audio": "entry_type != 'folder' AND file_type LIKE 'audio/%'",
+        "videos": "entry_type != 'folder' AND file_type LIKE 'video/%'",
+        "text": f"entry_type != 'folder' AND NOT COALESCE({_MEDIA}, 0) AND content != ''",
+        "other": f"entry_type != 'folder' AND NOT COALESCE({_MEDIA}, 0) AND COALESCE(content, '') = ''",
+}
+# Categories entry.html can lazy-load; the others are always rendered in full
+LAZY_CATEGORIES = ("folders", "images", "text")
+# Page sizes of /api/entry/<id>/children
+CHILDREN_PAGE_SIZE = 50
+CHILDREN_PAGE_MAX = 200
 
 # Force UTF-8 encoding for stdout and stderr
 sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
 sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
 
 
+def format_cursor(position_marker, entry_id):
+    """Pagination cursor of an entry; an empty marker stands for NULL."""
+    return f"{'' if position_marker is None else position_marker}:{entry_id}"
+
+
+def parse_cursor(value):
+    """(position_marker, id) from a cursor made by format_cursor; raises ValueError."""
+    position_marker, _, entry_id = value.partition(':')
+    try:
+        return (int(position_marker) if position_marker else None), int(entry_id)
+    except ValueError:
+        raise ValueError(f"invalid cursor {value!r}")
+
+
+def parse_children_query(query):
+    """(category, after, limit) from the query string of a children request; raises ValueError."""
+    params = parse_qs(query)
+    category = params.get('category', [None])[0] or None
+    if category is not None and category not in CHILD_CATEGORIES:
+        raise ValueError(f"unknown category {category!r}")
+    after = params.get('after', [None])[0]
+    after = parse_cursor(after) if after else None
+    try:
+        limit = int(params.get('limit', [CHILDREN_PAGE_SIZE])[0])
+    except ValueError:
+        raise ValueError("limit must be a number")
+    return category, after, min(max(limit, 1), CHILDREN_PAGE_MAX)
+
+
+def canonical_children_query(query):
+    category, after, limit = parse_children_query(query)
+    params = [('category', category or ''), ('after', format_cursor(*after) if after else ''), ('limit', limit)]
+    return urlencode(params)
+
+
 class NLPApp:
-    def __init__(self, static_dir ="static", template_dir='/var/www/natur-lehrpfad.de/app/templates', db_path='/var/www/natur-lehrpfad.de/app/lehr_pfad.db'):
-        self.env = Environment(loader=FileSystemLoader(template_dir))
+    def __init__(self, static_dir ="static", template_dir='/var/www/natur-lehrpfad.de/app/templates', db_path='/var/www/natur-lehrpfad.de/app/lehr_pfad.db', use_tree_index=True, page_cache_size=512, serve_static=False, export_dir=None, log_sample_rate=LOG_SAMPLE_RATE, stream_pages=False,
+                 compress_pages=COMPRESS_PAGES, children_page_size=None, bytecode_cache_dir=None,
+                 read_only=READ_ONLY, derivatives_dir=None, derivatives_url='/d'):
+        # Compiled templates are kept on disk so new worker processes skip the compile step
+        self.env = Environment(loader=FileSystemLoader(template_dir), bytecode_cache=self.make_bytecode_cache(bytecode_cache_dir))
         self.db_path = db_path
         self.static_dir = static_dir
+        # Serve /s/ media from static_dir ourselves when there is no Apache alias in front
+        self.serve_static = serve_static
+        # Resized images written by the importer (import.py --derivatives); served from here only with serve_static
+        self.derivatives_dir = derivatives_dir
+        self.derivatives_url = derivatives_url
+        # One persistent connection per worker thread instead of one per query
+        self.read_only = read_only
+        self.db = ConnectionManager(db_path, read_only=read_only)
+        # Navigation is served from an in-memory index shared by all threads of the worker
+        self.use_tree_index = use_tree_index
+        self._tree_index = None
+        self._tree_lock = threading.Lock()
+        self._site_map_cache = (None, None, None)  # (db stamp, site map, html) without the index
+        self._schema_checked = False
+        # Set when a read for the page being rendered fails; such pages are served but not cached
+        self._render_state = threading.local()
+        # Rendered pages are keyed by route and database generation
+        self.page_cache = PageCache(page_cache_size)
+        self.generation = 0
+        self._db_seen_stamp = None
+        # Static HTML copies of the pages, kept current when entries are saved
+        self.exporter = None
+        if export_dir:
+            from export_static import StaticExporter
+            self.exporter = StaticExporter(self, export_dir)
+        # Per-process counters and histograms for /metrics
+        self.metrics = Metrics()
+        self.log_sample_rate = log_sample_rate
+        # Send entry pages while they render instead of after
+        self.stream_pages = stream_pages
+        # Negotiate gzip (and brotli, if installed) for rendered pages
+        self.compress_pages = compress_pages
+        self.encodings = available_encodings()
+        # Entry pages render this many children per category and lazy-load the rest; None renders all
+        self.children_page_size = children_page_size
 
     logging.basicConfig(
-        level=logging.DEBUG,  # Log level
+        level=os.environ.get('NLPAPP_LOG_LEVEL', 'DEBUG'),  # Log level
         format='%(asctime)s [%(levelname)s] %(message)s',
         handlers=[
-            logging.FileHandler('/var/log/apache2/nlpapp_debug.log'),  # Write to a custom log file
+            logging.FileHandler('/var/log/apache2/nlpapp_debug.log', delay=True),  # Write to a custom log file
             logging.StreamHandler(sys.stderr)  # Still send logs to Apache's error log
         ]
     )
+    logging.getLogger().addFilter(SampledDebugFilter())
+
+
+    def make_bytecode_cache(self, directory):
+        """Jinja bytecode cache in directory, or None if it is not set or not writable."""
+        if not directory:
+            return None
+        try:
+            os.makedirs(directory, exist_ok=True)
+            if not os.access(directory, os.W_OK):
+                raise PermissionError(f"{directory} is not writable")
+            return FileSystemBytecodeCache(directory)
+        except OSError as e:
+            logging.warning(f"Template bytecode cache disabled: {e}")
+            return None
 
+    def warm_up(self):
+        """Do the work of a worker's first request up front. Returns the seconds per step.
 
+        Compiles every template (through the bytecode cache, if any), loads the
+        Markdown extensions, migrates the schema, builds the navigation index
+        and site map and renders the index page into the page cache.
+        """
+        steps = [
+                ('templates', lambda: [self.env.get_template(name) for name in self.env.list_templates(extensions=['html'])]),
+                ('markdown', lambda: self.convert_markdown("*warm-up*")),
+                ('schema', self.ensure_schema),
+                ('navigation', lambda: (self.get_main_entries(), self.get_site_map_html())),
+                ('index', lambda: self.get_page('/')),
+        ]
+        timings = {}
+        for name, step in steps:
+            started = time.perf_counter()
+            try:
+                step()
+            except Exception as e:
+                # A failed step only means the first request does that work itself
+                logging.error(f"Warm-up step {name} failed: {e}")
+            timings[name] = time.perf_counter() - started
+        total = sum(timings.values())
+        self.metrics.observe('nlpapp_warmup_seconds', total, help="Time spent warming up a worker process.")
+        logging.info("Warm-up took %.0f ms (%s)", total * 1000,
+                     ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in timings.items()))
+        return timings
+
+    @timed('markdown')
     def convert_markdown(self, content):
         """Convert Markdown content to HTML."""
-        if content:
-            return markdown.markdown(content)
-        return ""
+        return convert_markdown(content)
+
+    def ensure_schema(self):
+        """Apply pending schema migrations to databases created by older importers."""
+        if self._schema_checked:
+            return
+        conn = self.db.connection()
+        if self.read_only:
+            # Nothing may be written; the importer migrates the databases it swaps in
+            version = schema_version(conn)
+            if version < SCHEMA_VERSION:
+                logging.warning("Read-only database %s has schema version %s of %s", self.db_path, version, SCHEMA_VERSION)
+        else:
+            migrate(conn)
+        self._schema_checked = True
 
-    def render_template(self, template_name, context={}):
+    @timed('render')
+    def render_template(self, template_name, context={}, stream=False):
         #logging.debug(f"Rendering template: {template_name} with context: {context}")
         template = self.env.get_template(template_name)
+        if stream:
+            # Lazily rendered pieces; the template only runs as they are consumed
+            return template.generate(context)
         return template.render(context)
 
     def sanitize_path(self, path):
@@ -54,60 +222,153 @@ class NLPApp:
         return normalized_path.lstrip('/')
 
 
+    def send_static(self, environ, start_response, path, root_dir=None):
+        """Serve a file below static_dir (or root_dir) for the media routes."""
+        relative_path = self.sanitize_path(path)
+        root = os.path.realpath(root_dir or self.static_dir)
+        file_path = os.path.realpath(os.path.join(root, relative_path)) if relative_path else None
+        # realpath also catches symlinks pointing out of the media tree
+        if not file_path or os.path.commonpath([root, file_path]) != root or not os.path.isfile(file_path):
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b"File not found"]
+        return serve_file(environ, start_response, file_path)
+
+    def _db_stamp(self):
+        """Cheap fingerprint of the database files, changes whenever another process writes."""
+        stamp = []
+        for path in (self.db_path, self.db_path + '-wal'):
+            try:
+                st = os.stat(path)
+                stamp.append((st.st_ino, st.st_mtime_ns, st.st_size))
+            except OSError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def _db_mtime(self):
+        """Last write to the database files in whole seconds, used as Last-Modified."""
+        mtimes = [entry[1] for entry in self._db_stamp() if entry]
+        return max(mtimes) // 1_000_000_000 if mtimes else None
+
+    def check_database(self):
+        """Drop cached state if the database changed on disk and return the current generation."""
+        stamp = self._db_stamp()
+        if stamp != self._db_seen_stamp:
+            with self._tree_lock:
+                if stamp != self._db_seen_stamp:
+                    if self._db_seen_stamp is not None:
+                        logging.info("Database %s changed on disk, dropping caches", self.db_path)
+                    self._tree_index = None
+                    # A replaced database may predate the current schema
+                    self._schema_checked = False
+                    self.page_cache.clear()
+                    self.generation += 1
+                    self._db_seen_stamp = stamp
+        return self.generation
+
+    def begin_render(self):
+        self._render_state.failed = False
+
+    def mark_load_failed(self):
+        """Note that a read for the page being rendered failed, so the page must not be cached."""
+        self._render_state.failed = True
+
+    def render_failed(self):
+        """True if a read failed since this thread's last begin_render."""
+        return getattr(self._render_state, 'failed', False)
+
+    @timed('tree_index')
+    def get_tree_index(self):
+        """Return the navigation index, reloading it when the database changed on disk."""
+        self.check_database()
+        index = self._tree_index
+        if index is None:
+            with self._tree_lock:
+                if self._tree_index is None:
+                    self._tree_index = TreeIndex.load(self.db.connection())
+                index = self._tree_index
+        return index
+
+
+    @timed('main_entries')
     def get_main_entries(self):
         """Fetch all top-level entries (folders and files) from the database."""
+        if self.use_tree_index:
+            try:
+                return self.get_tree_index().main_entries()
+            except Exception as e:
+                logging.error(f"Error fetching main entries: {e}")
+                self.mark_load_failed()
+                return []
         try:
             logging.debug("Fetching main entries from database.")
-            conn = sqlite3.connect(self.db_path)
+            conn = self.db.connection()
             cursor = conn.cursor()
             cursor.execute("SELECT id, filename, entry_type, content FROM file_entries WHERE parent_id IS NULL")
             main_entries = cursor.fetchall()
-            conn.close()
-            logging.debug(f"Main entries fetched: {main_entries}")
+            logging.debug("Fetched %d main entries", len(main_entries))
             return main_entries
         except Exception as e:
             logging.error(f"Error fetching main entries: {e}")
+            self.mark_load_failed()
             return []
 
 
+    @timed('breadcrumbs')
     def get_breadcrumbs(self, main_entry_id):
         """Fetch breadcrumbs for the current entry and return a list of dictionaries."""
+        if self.use_tree_index:
+            try:
+                return self.get_tree_index().breadcrumbs(main_entry_id)
+            except Exception as e:
+                logging.error(f"Error fetching breadcrumbs: {e}")
+                self.mark_load_failed()
+                return [], ""
         try:
-            conn = sqlite3.connect(self.db_path)
+            self.ensure_schema()
+            conn = self.db.connection()
             cursor = conn.cursor()
-            cursor.execute("""
+            # The materialized path holds the ancestor ids, so the whole chain is one primary key lookup
+            row = cursor.execute("SELECT path FROM file_entries WHERE id = ?", (main_entry_id,)).fetchone()
+            if row is None or row[0] is None:
+                logging.warning("No path stored for entry %s", main_entry_id)
+                return [], ""
+            ids = path_ids(row[0]) + [int(main_entry_id)]
+            cursor.execute(f"""
                     SELECT id, filename, level
                     FROM file_entries
-                    WHERE id IN (
-                            WITH RECURSIVE breadcrumb AS (
-                                    SELECT id, parent_id, level FROM file_entries WHERE id = ?
-                                    UNION ALL
-                                    SELECT f.id, f.parent_id, f.level
-                                    FROM file_entries f
-                                    INNER JOIN breadcrumb b ON f.id = b.parent_id
-                            )
-                            SELECT id FROM breadcrumb
-                    )
+                    WHERE id IN ({','.join('?' * len(ids))})
                     ORDER BY level ASC;
-            """, (main_entry_id,))
+            """, ids)
             rows = cursor.fetchall()
-            conn.close()
 
             # Convert rows into dictionaries for attribute-based access
             breadcrumbs = [{"id": row[0], "filename": row[1], "level": row[2]} for row in rows]
             base_path = "/".join([crumb["filename"] for crumb in breadcrumbs if crumb["id"] != 1])
             ## base_path = "/".join([crumb["filename"] for crumb in breadcrumbs])
-            logging.debug(f"Fetched breadcrumbs for entry {main_entry_id}: {breadcrumbs}")
+            logging.debug("Fetched %d breadcrumbs for entry %s", len(breadcrumbs), main_entry_id)
             return breadcrumbs, base_path
         except Exception as e:
             logging.error(f"Error fetching breadcrumbs: {e}")
-            return []
+            self.mark_load_failed()
+            return [], ""
 
 
+    @timed('site_map')
     def get_site_map(self):
         """Fetch the full site map with content as the primary display name, falling back to filename."""
+        if self.use_tree_index:
+            try:
+                return self.get_tree_index().site_map()
+            except Exception as e:
+                logging.error(f"Error fetching site map: {e}")
+                self.mark_load_failed()
+                return []
+        self.ensure_schema()
+        stamp = self._db_stamp()
+        if self._site_map_cache[0] == stamp:
+            return self._site_map_cache[1]
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self.db.connection()
             cursor = conn.cursor()
             cursor.execute("""
                     SELECT id, COALESCE(content, filename) AS display_name, parent_id, level
@@ -116,29 +377,49 @@ class NLPApp:
                     ORDER BY level ASC, parent_id ASC, id ASC;
             """)
             rows = cursor.fetchall()
-            conn.close()
-
-            # Convert rows to a lookup table for fast access
-            entry_lookup = {row[0]: {"id": row[0], "display_name": row[1], "parent_id": row[2], "level": row[3], "children": []} for row in rows}
-
-            # Recursive function to build the tree
-            def build_tree(parent_id):
-                return [{**entry, "children": build_tree(entry["id"])} for entry in entry_lookup.values() if entry["parent_id"] == parent_id]
-                #return [entry | {"children": build_tree(entry["id"])} for entry in entry_lookup.values() if entry["parent_id"] == parent_id]
 
-            # Build the tree starting from the root (parent_id = NULL)
-            site_map = build_tree(None)
-            logging.debug(f"Constructed site map tree: {site_map}")
+            site_map = build_site_map(rows)
+            logging.debug("Constructed site map tree with %d top-level folders", len(site_map))
 
+            self._site_map_cache = (stamp, site_map, None)
             return site_map
         except Exception as e:
             logging.error(f"Error fetching site map: {e}")
+            self.mark_load_failed()
             return []
 
+    def get_site_map_html(self):
+        """Return the rendered site map fragment, cached for the current database version."""
+        if self.use_tree_index:
+            cache = self.get_tree_index().cache
+            if "site_map_html" in cache:
+                return cache["site_map_html"]
+            html = self.render_template('site_map.html', {'site_map': self.get_site_map()})
+            # An empty map from a failed read is not kept
+            if not self.render_failed():
+                cache["site_map_html"] = html
+            return html
+
+        site_map = self.get_site_map()
+        stamp, cached_map, html = self._site_map_cache
+        if html is None or cached_map is not site_map:
+            html = self.render_template('site_map.html', {'site_map': site_map})
+            if not self.render_failed():
+                self._site_map_cache = (stamp, site_map, html)
+        return html
+
+    @timed('siblings')
     def get_sibling_navigation(self, current_id):
         """Fetch the previous and next sibling folders for the current entry."""
+        if self.use_tree_index:
+            try:
+                return self.get_tree_index().siblings(current_id)
+            except Exception as e:
+                logging.error(f"Error fetching sibling navigation: {e}")
+                self.mark_load_failed()
+                return None, None
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self.db.connection()
             cursor = conn.cursor()
 
             # Fetch all sibling folders
@@ -155,105 +436,199 @@ class NLPApp:
 
             siblings = cursor.fetchall()
             siblings = [(int(s[0]), s[1].strip()) for s in siblings]  # Normalize IDs to integers
-            conn.close()
-            logging.debug(f"Siblings fetched: {siblings}")
+            logging.debug("Fetched %d siblings for entry %s", len(siblings), current_id)
 
             # Find the current entry in the siblings list
             previous_entry = None
             next_entry = None
             for i, sibling in enumerate(siblings):
-                logging.debug(f"Checking sibling: {sibling}")
                 if sibling[0] == int(current_id):
                     if i > 0:
                         previous_entry = siblings[i - 1]
-                        logging.debug(f"Set previous_entry: {previous_entry}")
+                        logging.debug("Set previous_entry: %s", previous_entry)
                     if i < len(siblings) - 1:
                         next_entry = siblings[i + 1]
-                        logging.debug(f"Set next_entry: {next_entry}")
+                        logging.debug("Set next_entry: %s", next_entry)
                     break
 
             return previous_entry, next_entry
         except Exception as e:
             logging.error(f"Error fetching sibling navigation: {e}")
+            self.mark_load_failed()
             return None, None
 
     def get_main_entry_details(self, folder_id):
         """Fetch details of a folder entry and its associated file entries."""
-        try:
-            logging.debug(f"Fetching details for folder entry {folder_id}.")
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+        folder_entry = self.get_folder_entry(folder_id)
+        if not folder_entry:
+            return None, {"folders": [], "images": [], "audio": [], "videos": [], "text": [], "other": []}
+        return folder_entry, self.get_entry_children(folder_id)
 
-            # Fetch folder details
-            cursor.execute('SELECT id, filename, content FROM file_entries WHERE id = ? AND entry_type = "folder"', (folder_id,))
-            folder_entry = cursor.fetchone()
+    @timed('db_folder')
+    def get_folder_entry(self, folder_id):
+        """Fetch a folder entry as an (id, filename, content) tuple, or None."""
+        try:
+            logging.debug("Fetching details for folder entry %s.", folder_id)
+            if self.use_tree_index:
+                node = self.get_tree_index().get(folder_id)
+                folder_entry = (node["id"], node["filename"], node["content"]) if node and node["entry_type"] == "folder" else None
+            else:
+                cursor = self.db.connection().cursor()
+                cursor.execute('SELECT id, filename, content FROM file_entries WHERE id = ? AND entry_type = "folder"', (folder_id,))
+                folder_entry = cursor.fetchone()
 
             if not folder_entry:
-                logging.warning(f"No folder entry found for id {folder_id}.")
-                return None, {"folders": [], "images": [], "audio": [], "videos": [], "text": [], "other": []}
+                logging.warning("No folder entry found for id %s.", folder_id)
+            return folder_entry
+        except Exception as e:
+            logging.error(f"Error fetching folder entry: {e}")
+            self.mark_load_failed()
+            return None
+
+    def child_entry(self, row):
+        """Category and template dictionary of a child row."""
+        id_, filename, entry_type, file_type, content, position_marker, content_html, width, height, duration, size, derivatives = row
+        # Rendered at import/save time; only rows missed by a backfill are converted here
+        if content:
+            html = content_html if content_html is not None else self.convert_markdown(content)
+        else:
+            html = None
+        entry = {
+                "id": id_,
+                "filename": filename,
+                "entry_type": entry_type,
+                "file_type": file_type,
+                "content": html,
+                "position_marker": position_marker,
+                "width": width,
+                "height": height,
+                "duration": duration,
+                "duration_label": f"{int(duration // 60)}:{int(duration % 60):02d}" if duration else None,
+                "bytes": size,
+                # Resized copies written by the importer: the largest is the default source
+                "src": None,
+                "srcset": None
+        }
+        if derivatives:
+            urls = [(w, f"{self.derivatives_url}/{quote(rel_path)}") for w, rel_path in json.loads(derivatives)]
+            if urls:
+                entry["src"] = urls[-1][1]
+                entry["srcset"] = ", ".join(f"{url} {w}w" for w, url in urls)
+        if entry_type == "folder":
+            category = "folders"
+        elif file_type and file_type.startswith("image/"):
+            category = "images"
+        elif file_type and file_type.startswith("audio/"):
+            category = "audio"
+        elif file_type and file_type.startswith("video/"):
+            category = "videos"
+        elif content:
+            category = "text"
+        else:
+            category = "other"
+        return category, entry
+
+    @timed('db_children')
+    def get_entry_children(self, folder_id, limit=None):
+        """Fetch the entries of a folder, grouped into folders, images, audio, videos, text and other.
+
+        With a limit only the first page of each category in LAZY_CATEGORIES
+        is fetched, and parsed_entries["next"] holds the cursor of each
+        category's next page. The other categories are fetched in full.
+        """
+        parsed_entries = {category: [] for category in CHILD_CATEGORIES}
+        try:
+            if limit:
+                parsed_entries["next"] = {}
+                for category in CHILD_CATEGORIES:
+                    page_limit = limit if category in LAZY_CATEGORIES else None
+                    parsed_entries[category], parsed_entries["next"][category] = self.get_children_page(folder_id, category, limit=page_limit)
+                return parsed_entries
+
+            self.ensure_schema()
+            cursor = self.db.connection().cursor()
 
             # Fetch associated entries
             cursor.execute('''
-                    SELECT id, filename, entry_type, file_type, content, position_marker
+                    SELECT id, filename, entry_type, file_type, content, position_marker, content_html,
+                           media_width, media_height, media_duration, source_size, derivatives
                     FROM file_entries
                     WHERE parent_id = ?
-                    ORDER BY position_marker
+                    ORDER BY position_marker, id
             ''', (folder_id,))
-            entries = cursor.fetchall()
-            conn.close()
-
-            # Organize entries into categories
-            parsed_entries = {
-                    "folders": [],  # Subfolders
-                    "images": [],
-                    "audio": [],
-                    "videos": [],
-                    "text": [],
-                    "other": []
-            }
-
-            for id_, filename, entry_type, file_type, content, position_marker in entries:
-                content = self.convert_markdown(content) if content else None
-                entry = {
-                        "id": id_,
-                        "filename": filename,
-                        "entry_type": entry_type,
-                        "file_type": file_type,
-                        "content": content,
-                        "position_marker": position_marker
-                }
-                if entry_type == "folder":
-                    parsed_entries["folders"].append(entry)  # Separate folders
-                elif file_type and file_type.startswith("image/"):
-                    parsed_entries["images"].append(entry)
-                elif file_type and file_type.startswith("audio/"):
-                    parsed_entries["audio"].append(entry)
-                elif file_type and file_type.startswith("video/"):
-                    parsed_entries["videos"].append(entry)  # New video category
-                elif content:
-                    parsed_entries["text"].append(entry)
-                else:
-                    parsed_entries["other"].append(entry)
 
-            #logging.debug(f"Folder entry details: {folder_entry}, parsed entries: {parsed_entries}")
-            return folder_entry, parsed_entries
+            for row in cursor.fetchall():
+                category, entry = self.child_entry(row)
+                parsed_entries[category].append(entry)
+            return parsed_entries
         except Exception as e:
             logging.error(f"Error fetching folder entry details: {e}")
-            return None, {"folders": [], "images": [], "audio": [], "videos": [], "text": [], "other": []}
+            self.mark_load_failed()
+            return parsed_entries
+
+    def get_children_page(self, folder_id, category=None, after=None, limit=CHILDREN_PAGE_SIZE):
+        """One page of a folder's children in (position_marker, id) order.
+
+        after is the (position_marker, id) of the last entry of the previous
+        page; a limit of None fetches the rest. Returns the entries and the
+        cursor of the next page, or None on the last page.
+        """
+        self.ensure_schema()
+        conditions = ["parent_id = ?"]
+        params = [folder_id]
+        if category is not None:
+            conditions.append(CHILD_CATEGORIES[category])
+        if after is not None:
+            # NULL markers sort first, so they come before every numbered entry
+            position_marker, last_id = after
+            if position_marker is None:
+                conditions.append("((position_marker IS NULL AND id > ?) OR position_marker IS NOT NULL)")
+                params.append(last_id)
+            else:
+                conditions.append("(position_marker > ? OR (position_marker = ? AND id > ?))")
+                params += [position_marker, position_marker, last_id]
+
+        cursor = self.db.connection().cursor()
+        cursor.execute(f"""
+                SELECT id, filename, entry_type, file_type, content, position_marker, content_html,
+                       media_width, media_height, media_duration, source_size, derivatives
+                FROM file_entries
+                WHERE {' AND '.join(conditions)}
+                ORDER BY position_marker, id
+                LIMIT ?
+        """, params + [-1 if limit is None else limit + 1])
+        rows = cursor.fetchall()
 
+        entries = [self.child_entry(row)[1] for row in rows[:limit]]
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            last = entries[-1]
+            next_cursor = format_cursor(last["position_marker"], last["id"])
+        return entries, next_cursor
 
+    def render_children_page(self, folder_id, query):
+        """JSON page of a folder's children, or None if the folder does not exist."""
+        if not self.get_folder_entry(folder_id):
+            return None
+        category, after, limit = parse_children_query(query)
+        entries, next_cursor = self.get_children_page(int(folder_id), category, after, limit)
+        body = json.dumps({"id": int(folder_id), "category": category, "entries": entries, "next": next_cursor},
+                          ensure_ascii=False)
+        tags = {int(folder_id)} | {entry["id"] for entry in entries}
+        return CachedPage(body.encode('utf-8'), content_type='application/json; charset=utf-8', tags=tags)
+
+    @timed('db_entry')
     def get_entry_by_id(self, entry_id):
         """Fetch a single entry by ID."""
         try:
-            logging.debug(f"Fetching entry with ID {entry_id}")
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT id, parent_id, filename, content FROM file_entries WHERE id = ?", (entry_id,))
-                entry = cursor.fetchone()
+            logging.debug("Fetching entry with ID %s", entry_id)
+            cursor = self.db.connection().cursor()
+            cursor.execute("SELECT id, parent_id, filename, content FROM file_entries WHERE id = ?", (entry_id,))
+            entry = cursor.fetchone()
 
             if entry:
                 parent_id = entry[1] if entry[1] is not None else 1
-                logging.debug(f"Fetched entry: {entry}")
+                logging.debug("Fetched entry %s", entry[0])
                 return {
                         "id": entry[0],
                         "parent_id": parent_id,
@@ -261,89 +636,416 @@ class NLPApp:
                         "content": entry[3]
                 }
             else:
-                logging.warning(f"No entry found with ID {entry_id}")
+                logging.warning("No entry found with ID %s", entry_id)
                 return None
         except Exception as e:
             logging.error(f"Error fetching entry: {e}")
+            self.mark_load_failed()
             return None
 
 
+    @timed('db_update')
     def update_entry(self, entry_id, content):
         """Update an entry in the database."""
         try:
-            logging.debug(f"Updating entry {entry_id} with new content")
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute("UPDATE file_entries SET content = ? WHERE id = ?", (content, entry_id))
-            conn.commit()
-            conn.close()
-            logging.debug(f"Entry {entry_id} updated successfully")
+            logging.debug("Updating entry %s with new content", entry_id)
+            self.ensure_schema()
+            content_html = self.convert_markdown(content) if content else None
+            for attempt in range(2):
+                conn = self.db.connection()
+                with conn:  # commits, or rolls back so the thread's connection is not left in a transaction
+                    conn.execute("BEGIN IMMEDIATE")
+                    # Checked under the write lock: a database renamed over ours must get the write, not the old file
+                    if self.db.is_current():
+                        # Nobody else can write while we hold the lock, so this covers every earlier write
+                        before = self._db_stamp()
+                        conn.execute("UPDATE file_entries SET content = ?, content_html = ? WHERE id = ?", (content, content_html, entry_id))
+                        version = conn.execute("PRAGMA data_version").fetchone()[0]
+                        break
+                logging.info("Database %s was replaced while saving entry %s, retrying", self.db_path, entry_id)
+            else:
+                raise RuntimeError(f"{self.db_path} was replaced twice while saving")
+            after = self._db_stamp()
+            # data_version ignores this connection's own commits: a change means someone else wrote since
+            if conn.execute("PRAGMA data_version").fetchone()[0] != version:
+                after = None
+            self._after_update(entry_id, content, before, after)
+            logging.debug("Entry %s updated successfully", entry_id)
             return True
         except Exception as e:
             logging.error(f"Error updating entry: {e}")
             return False
 
 
+    @timed('db_search')
+    def search(self, query, page=1, per_page=20):
+        """Full-text search with breadcrumb paths; returns (hits, total)."""
+        try:
+            self.ensure_schema()
+            hits, total = search_entries(self.db.connection(), query, page, per_page)
+            for hit in hits:
+                # Files are shown on their folder's page
+                hit["page_id"] = hit["id"] if hit["entry_type"] == "folder" else hit["parent_id"]
+                breadcrumbs, _ = self.get_breadcrumbs(hit["page_id"])
+                hit["breadcrumbs"] = breadcrumbs
+            return hits, total
+        except Exception as e:
+            logging.error(f"Error searching for {query!r}: {e}")
+            return [], 0
+
+    def render_search_page(self, query, page):
+        """Render the search results page."""
+        per_page = 20
+        hits, total = self.search(query, page, per_page)
+        html = self.render_template('search.html', {
+                'query': query,
+                'hits': hits,
+                'total': total,
+                'page': page,
+                'pages': (total + per_page - 1) // per_page
+        })
+        with phase('encode'):
+            return html.encode('utf-8')
+
+    def _after_update(self, entry_id, content, before=None, after=None):
+        """Patch in-process caches after our own write instead of dropping them all.
+
+        before and after are the database stamps around the write. The new
+        stamp is only adopted if nothing else wrote around it; otherwise the
+        next check_database() drops the caches for that other write.
+        """
+        with self._tree_lock:
+            if self._tree_index is not None:
+                site_map_changed = self._tree_index.update_content(entry_id, content)
+            else:
+                site_map_changed = True
+                self._site_map_cache = (None, None, None)
+            if after is not None and before == self._db_seen_stamp:
+                self._db_seen_stamp = after
+
+        # Pages showing this entry: its edit page, its parent's page and, for
+        # folders, the sibling navigation and every page carrying the site map
+        tags = {int(entry_id)}
+        if site_map_changed:
+            tags.add('site_map')
+        dropped = self.page_cache.invalidate(tags)
+        logging.debug("Invalidated %d cached pages after updating entry %s", dropped, entry_id)
+
+        if self.exporter is not None:
+            try:
+                if site_map_changed:
+                    # Every exported page carries the site map; re-rendering them all would hold up the redirect
+                    self.exporter.refresh_later(tags)
+                else:
+                    self.exporter.refresh(tags)
+            except Exception as e:
+                logging.error(f"Error regenerating static pages after updating entry {entry_id}: {e}")
+
+    def render_index_page(self):
+        """Render the list of top-level entries."""
+        main_entries = self.get_main_entries()
+        html = self.render_template('index.html', {'main_entries': main_entries})
+        with phase('encode'):
+            return CachedPage(html.encode('utf-8'), tags=[entry[0] for entry in main_entries])
+
+    def entry_context(self, main_entry_id):
+        """Template context of an entry page, or None if the folder does not exist.
+
+        The header data is fetched right away. The folder's children and the
+        site map are loaded by the template itself when it reaches them, so a
+        streamed page can send its head and breadcrumbs first. Returns the
+        context and a dictionary that collects what the loaders fetched.
+        """
+        #EDIT_MODE = query_params.get('edit', ['false'])[0].lower() == 'true'
+        logging.debug("Edit mode: %s", EDIT_MODE)
+
+        main_entry = self.get_folder_entry(main_entry_id)
+        if not main_entry:
+            return None
+        breadcrumbs , base_path = self.get_breadcrumbs(main_entry_id)
+        previous_entry, next_entry = self.get_sibling_navigation(main_entry_id)
+        loaded = {}
+
+        def load_parsed_entries():
+            loaded['parsed_entries'] = self.get_entry_children(main_entry[0], limit=self.children_page_size)
+            return loaded['parsed_entries']
+
+        context = {
+                'main_entry': main_entry,
+                'load_parsed_entries': load_parsed_entries,
+                'breadcrumbs': breadcrumbs,
+                'base_path': base_path,
+                'load_site_map_html': self.get_site_map_html,
+                'previous_entry': previous_entry,
+                'next_entry': next_entry,
+                'children_page_size': self.children_page_size,
+                'EDIT_MODE': EDIT_MODE and not self.read_only
+        }
+        return context, loaded
+
+    def entry_page_tags(self, context, loaded):
+        """Entry ids shown on an entry page, for cache invalidation."""
+        tags = {'site_map', context['main_entry'][0]}
+        parsed_entries = loaded.get('parsed_entries', {})
+        tags.update(entry["id"] for category in CHILD_CATEGORIES for entry in parsed_entries.get(category, ()))
+        tags.update(sibling[0] for sibling in (context['previous_entry'], context['next_entry']) if sibling)
+        return tags
+
+    def render_entry_page(self, main_entry_id):
+        """Render the page of a folder entry, or return None if it does not exist."""
+        prepared = self.entry_context(main_entry_id)
+        if prepared is None:
+            return None
+        context, loaded = prepared
+        html = self.render_template('entry.html', context)
+        with phase('encode'):
+            return CachedPage(html.encode('utf-8'), tags=self.entry_page_tags(context, loaded))
+
+    def stream_entry_page(self, environ, start_response, path, key):
+        """Send an entry page while it renders and cache it once complete."""
+        epoch = self.page_cache.epoch
+        last_modified = self._db_mtime()
+        self.begin_render()
+        prepared = self.entry_context(path.split('/')[2])
+        if prepared is None:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b"Main entry not found"]
+        context, loaded = prepared
+        pieces = self.render_template('entry.html', context, stream=True)
+        # Only gzip can be flushed chunk by chunk with the standard library
+        coding = self.choose_encoding(environ, ('gzip',))
+        headers = [('Content-Type', 'text/html; charset=utf-8'), ('Cache-Control', 'no-cache')] + self.vary_headers()
+        if coding:
+            headers.append(('Content-Encoding', coding))
+        start_response('200 OK', headers)
+        self.count_encoding(coding)
+
+        def chunks():
+            body = []
+            buffer = []
+            size = 0
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if coding else None
+            try:
+                while True:
+                    # The template runs as it is iterated, so this is where a streamed page renders
+                    with phase('render'):
+                        piece = next(pieces, None)
+                    if piece is None:
+                        break
+                    buffer.append(piece)
+                    size += len(piece)
+                    if size >= STREAM_CHUNK_SIZE or STREAM_FLUSH_MARKER in piece:
+                        chunk = "".join(buffer).encode('utf-8')
+                        body.append(chunk)
+                        buffer, size = [], 0
+                        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH) if compressor else chunk
+                if buffer:
+                    chunk = "".join(buffer).encode('utf-8')
+                    body.append(chunk)
+                    yield compressor.compress(chunk) if compressor else chunk
+                if compressor:
+                    yield compressor.flush()
+            except Exception as e:
+                # Headers are gone already; all we can do is stop and not cache the page
+                logging.error(f"Error while streaming {path}: {e}", exc_info=True)
+                return
+            if self.render_failed():
+                logging.warning(f"Not caching {path}, some of its data could not be read")
+                return
+            page = CachedPage(b"".join(body), tags=self.entry_page_tags(context, loaded), last_modified=last_modified)
+            self.page_cache.put(key, page, epoch)
+
+        return chunks()
+
+    def render_edit_page(self, entry_id):
+        """Render the edit form of an entry, or return None if it does not exist."""
+        entry = self.get_entry_by_id(entry_id)
+        if not entry:
+            return None
+        html = self.render_template('edit.html', {'entry': entry})
+        with phase('encode'):
+            return CachedPage(html.encode('utf-8'), tags=[entry["id"]])
+
+    def lookup_page(self, path, query=''):
+        """Return the cache key of a route and its cached page, or None on a miss."""
+        key = (path, query, self.check_database())
+        page = self.page_cache.get(key)
+        result = 'hit' if page is not None else 'miss'
+        self.metrics.inc('nlpapp_page_cache_total', (('result', result),), help="Page cache lookups, by result.")
+        return key, page
+
+    def get_page(self, path, query=''):
+        """Return the cached page for a route, rendering it on a miss.
+
+        A page rendered while a read failed is returned but not cached, and
+        render_failed() is True until the next call.
+        """
+        self.begin_render()
+        key, page = self.lookup_page(path, query)
+        if page is not None:
+            return page
+
+        epoch = self.page_cache.epoch
+        last_modified = self._db_mtime()
+        if path == '/':
+            page = self.render_index_page()
+        elif path.startswith('/entry/'):
+            page = self.render_entry_page(path.split('/')[2])
+        elif path.startswith('/api/entry/'):
+            page = self.render_children_page(path.split('/')[3], query)
+        else:
+            page = self.render_edit_page(path.split('/')[2])
+        if page is not None:
+            page.last_modified = last_modified
+            if self.render_failed():
+                logging.warning(f"Not caching {path}, some of its data could not be read")
+            else:
+                self.page_cache.put(key, page, epoch)
+        return page
+
+    def choose_encoding(self, environ, codings=None, size=None):
+        """Content coding to send a page in, or None to send it uncompressed."""
+        if not self.compress_pages or (size is not None and size < MIN_COMPRESS_SIZE):
+            return None
+        return negotiate_encoding(environ.get('HTTP_ACCEPT_ENCODING'), codings or self.encodings)
+
+    def vary_headers(self):
+        return [('Vary', 'Accept-Encoding')] if self.compress_pages else []
+
+    def count_encoding(self, coding):
+        self.metrics.inc('nlpapp_page_encoding_total', (('encoding', coding or 'identity'),),
+                         help="Rendered pages sent, by content coding.")
+
+    def send_page(self, environ, start_response, page):
+        """Send a cached page, answering conditional requests with 304."""
+        coding = self.choose_encoding(environ, size=len(page.body))
+        headers = page.headers(coding) + self.vary_headers()
+        if page.is_not_modified(environ, coding):
+            start_response('304 Not Modified', [h for h in headers if h[0] not in ('Content-Type', 'Content-Encoding')])
+            return [b""]
+        with phase('compress'):
+            body = page.variant(coding)
+        start_response('200 OK', headers + [('Content-Length', str(len(body)))])
+        self.count_encoding(coding)
+        return [body]
+
+    def send_json(self, start_response, status, data):
+        body = json.dumps(data).encode('utf-8')
+        start_response(status, [('Content-Type', 'application/json; charset=utf-8'), ('Content-Length', str(len(body)))])
+        return [body]
+
+    def route_name(self, path):
+        """Low-cardinality route label for metrics."""
+        if path == '/':
+            return 'index'
+        for prefix, name in (('/entry/', 'entry'), ('/edit/', 'edit'), ('/api/entry/', 'children'), ('/s/', 'static')):
+            if path.startswith(prefix):
+                return name
+        if path in ('/save', '/search', '/metrics'):
+            return path[1:]
+        return 'other'
+
     def __call__(self, environ, start_response):
+        """Time the request, add a Server-Timing header and record it in the metrics."""
+        timer = start_request(self.log_sample_rate)
+        path = environ.get('PATH_INFO', '/')
+        response = {'status': '500'}
+
+        def timed_start_response(status, headers, exc_info=None):
+            response['status'] = status
+            headers = list(headers) + [('Server-Timing', timer.server_timing())]
+            if exc_info:
+                return start_response(status, headers, exc_info)
+            return start_response(status, headers)
+
+        def finish():
+            self.metrics.record_request(self.route_name(path), response['status'], timer)
+            end_request()
+
+        try:
+            body = self.handle_request(environ, timed_start_response)
+        except BaseException:
+            finish()
+            raise
+        if isinstance(body, list):
+            finish()
+            return body
+        # Streamed pages render while the server iterates them; record the request once it is done
+        return FinishedBody(body, finish)
+
+    def handle_request(self, environ, start_response):
 
         path = environ.get('PATH_INFO', '/')
         #path = self.sanitize_path(raw_path)
-        logging.debug(f"Handling request path: {path}")
-        logging.debug(f"WSGI PATH_INFO: {environ.get('PATH_INFO')}")
+        logging.debug("Handling request path: %s", path)
 
         try:
             if path == '/':  # Index route
-                main_entries = self.get_main_entries()
-                html = self.render_template('index.html', {'main_entries': main_entries})
-                start_response('200 OK', [('Content-Type', 'text/html')])
-                return [html.encode('utf-8')]
+                return self.send_page(environ, start_response, self.get_page(path))
 
             elif path.startswith('/entry/'):  # Main entry details route
-                parsed_url = urlparse(path)
-                main_entry_id = path.split('/')[2]
-                main_entry, parsed_entries = self.get_main_entry_details(main_entry_id)
-
-                # Access query parameters from WSGI environ
-                query_string = environ.get('QUERY_STRING', '')  # Get raw query string
-                query_params = parse_qs(query_string)  # Parse into a dictionary
-
-                #EDIT_MODE = query_params.get('edit', ['false'])[0].lower() == 'true'
-                logging.error(f"Edit mode: {EDIT_MODE}")
-
-                main_entry, parsed_entries = self.get_main_entry_details(main_entry_id)
-                breadcrumbs , base_path = self.get_breadcrumbs(main_entry_id)
-                previous_entry, next_entry = self.get_sibling_navigation(main_entry_id)
-                site_map = self.get_site_map()
-                if main_entry:
-                    html = self.render_template('entry.html', {
-                            'main_entry': main_entry,
-                            'parsed_entries': parsed_entries,
-                            'breadcrumbs': breadcrumbs,
-                            'base_path': base_path,
-                            'site_map': site_map,
-                            'previous_entry': previous_entry,
-                            'next_entry': next_entry,
-                            'EDIT_MODE': EDIT_MODE
-                    })
-
-                    start_response('200 OK', [('Content-Type', 'text/html')])
-                    return [html.encode('utf-8')]
+                if self.stream_pages:
+                    key, page = self.lookup_page(path)
+                    if page is None:
+                        return self.stream_entry_page(environ, start_response, path, key)
+                else:
+                    page = self.get_page(path)
+                if page:
+                    return self.send_page(environ, start_response, page)
 
                 else:
                     start_response('404 Not Found', [('Content-Type', 'text/plain')])
                     return [b"Main entry not found"]
 
+            elif path.startswith(('/edit/', '/save')) and self.read_only:
+                start_response('403 Forbidden', [('Content-Type', 'text/plain')])
+                return [b"Editing is disabled"]
+
             elif path.startswith('/edit/'):  # Edit route
-                entry_id = path.split('/')[2]
-                entry = self.get_entry_by_id(entry_id)
-                if entry:
-                    html = self.render_template('edit.html', {'entry': entry})
-                    start_response('200 OK', [('Content-Type', 'text/html')])
-                    return [html.encode('utf-8')]
+                page = self.get_page(path)
+                if page:
+                    return self.send_page(environ, start_response, page)
                 else:
                     start_response('404 Not Found', [('Content-Type', 'text/plain')])
                     return [b"Entry not found"]
 
+            elif path.startswith('/api/entry/') and path.endswith('/children'):  # Paginated children of a folder
+                parts = path.split('/')
+                try:
+                    if len(parts) != 5 or not parts[3].isdigit():
+                        raise ValueError("invalid entry id")
+                    # Normalized so equivalent requests share a cache entry
+                    query = canonical_children_query(environ.get('QUERY_STRING', ''))
+                except ValueError as e:
+                    return self.send_json(start_response, '400 Bad Request', {"error": str(e)})
+                page = self.get_page(path, query)
+                if page:
+                    return self.send_page(environ, start_response, page)
+                return self.send_json(start_response, '404 Not Found', {"error": "entry not found"})
+
+            elif path == '/search':  # Full-text search route
+                query_params = parse_qs(environ.get('QUERY_STRING', ''))
+                query = query_params.get('q', [''])[0]
+                try:
+                    page = max(int(query_params.get('page', ['1'])[0]), 1)
+                except ValueError:
+                    page = 1
+                body = self.render_search_page(query, page)
+                start_response('200 OK', [('Content-Type', 'text/html; charset=utf-8'), ('Content-Length', str(len(body)))])
+                return [body]
+
+            elif path == '/metrics':  # Prometheus metrics of this worker process
+                body = self.metrics.render().encode('utf-8')
+                start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+                                          ('Content-Length', str(len(body)))])
+                return [body]
+
+            elif path.startswith('/s/') and self.serve_static:  # Media route
+                return self.send_static(environ, start_response, path[len('/s/'):])
+
+            elif path.startswith(self.derivatives_url + '/') and self.serve_static and self.derivatives_dir:  # Resized images
+                return self.send_static(environ, start_response, path[len(self.derivatives_url) + 1:], self.derivatives_dir)
+
             elif path == '/save':  # Save route
                 if environ['REQUEST_METHOD'] == 'POST':
                     try:
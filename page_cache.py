@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# bounded cache of rendered pages with HTTP validators
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+
+try:
+    import brotli
+except ImportError:  # optional, pages are then only offered gzipped
+    brotli = None
+
+# Smaller bodies are sent as they are, the saving would not pay for the extra work
+MIN_COMPRESS_SIZE = 1024
+
+
+def available_encodings():
+    """Content codings this process can produce, most preferred first."""
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def compress(body, coding):
+    if coding == 'br':
+        return brotli.compress(body, quality=9)
+    # mtime=0 keeps the output, and so its ETag, identical across renders
+    return gzip.compress(body, 6, mtime=0)
+
+
+def negotiate_encoding(accept_encoding, codings):
+    """Pick one of codings allowed by an Accept-Encoding header, or None for identity.
+
+    The highest q-value wins; ties go to the earlier entry in codings.
+    """
+    if not accept_encoding:
+        return None
+    weights = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name.strip().lower()] = q
+    best, best_q = None, 0.0
+    for coding in codings:
+        q = weights.get(coding, weights.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+class CachedPage:
+    """A rendered response body plus the validators and dependencies needed to reuse it."""
+
+    def __init__(self, body, content_type='text/html; charset=utf-8', tags=(), last_modified=None):
+        self.body = body
+        self.content_type = content_type
+        # Entry ids (and names like 'site_map') whose change makes this page stale
+        self.tags = frozenset(tags)
+        self.etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        self.last_modified = int(last_modified) if last_modified is not None else None
+        # Compressed bodies by content coding, made on first use and dropped with the page
+        self._variants = {}
+
+    def variant(self, coding=None):
+        """The body in the given content coding; None is the uncompressed body."""
+        if coding is None:
+            return self.body
+        body = self._variants.get(coding)
+        if body is None:
+            body = self._variants[coding] = compress(self.body, coding)
+        return body
+
+    def variant_etag(self, coding=None):
+        # Each coding is a different byte sequence and needs its own strong ETag
+        return self.etag if coding is None else '%s-%s"' % (self.etag[:-1], coding)
+
+    def headers(self, coding=None):
+        headers = [('Content-Type', self.content_type),
+                   ('ETag', self.variant_etag(coding)),
+                   ('Cache-Control', 'no-cache')]
+        if coding is not None:
+            headers.append(('Content-Encoding', coding))
+        if self.last_modified is not None:
+            headers.append(('Last-Modified', formatdate(self.last_modified, usegmt=True)))
+        return headers
+
+    def is_not_modified(self, environ, coding=None):
+        """Evaluate If-None-Match / If-Modified-Since against this page."""
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or self.variant_etag(coding) in tags
+
+        if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since and self.last_modified is not None:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return self.last_modified <= since
+        return False
+
+
+class PageCache:
+    """Thread-safe LRU of CachedPage objects with tag based invalidation."""
+
+    def __init__(self, max_pages=512):
+        self.max_pages = max_pages
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped on every invalidation so pages rendered before it are not stored
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self._pages)
+
+    def get(self, key):
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+            return page
+
+    def put(self, key, page, epoch=None):
+        if self.max_pages <= 0:
+            return
+        with self._lock:
+            if epoch is not None and epoch != self.epoch:
+                return
+            self._pages[key] = page
+            self._pages.move_to_end(key)
+            while len(self._pages) > self.max_pages:
+                self._pages.popitem(last=False)
+
+    def invalidate(self, tags):
+        """Drop every page that depends on one of the given tags."""
+        tags = set(tags)
+        with self._lock:
+            self.epoch += 1
+            stale = [key for key, page in self._pages.items() if page.tags & tags]
+            for key in stale:
+                del self._pages[key]
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self.epoch += 1
+            self._pages.clear()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# markdown rendering shared by the importer and the app, plus a backfill command
+import sys
+import logging
+import sqlite3
+import markdown
+
+
+def convert_markdown(content):
+    """Convert Markdown content to HTML."""
+    if content:
+        return markdown.markdown(content)
+    return ""
+
+
+def ensure_html_column(conn):
+    """Add the content_html column to file_entries if the database predates it."""
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(file_entries)")]
+    if columns and "content_html" not in columns:
+        conn.execute("ALTER TABLE file_entries ADD COLUMN content_html TEXT")
+        conn.commit()
+        logging.info("Added content_html column to file_entries")
+
+
+def rerender_all(db_path, only_missing=False, batch_size=500):
+    """Render the Markdown of every entry into content_html. Returns the number of rows written."""
+    conn = sqlite3.connect(db_path)
+    try:
+        ensure_html_column(conn)
+        query = "SELECT id, content FROM file_entries WHERE content IS NOT NULL"
+        if only_missing:
+            query += " AND content_html IS NULL"
+        rows = conn.execute(query).fetchall()
+
+        count = 0
+        for start in range(0, len(rows), batch_size):
+            batch = [(convert_markdown(content), id_) for id_, content in rows[start:start + batch_size]]
+            conn.executemany("UPDATE file_entries SET content_html = ? WHERE id = ?", batch)
+            conn.commit()
+            count += len(batch)
+        logging.info(f"Rendered Markdown for {count} entries in {db_path}")
+        return count
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    # Usage: render_markdown.py <db_path> [--missing]
+    if len(sys.argv) < 2:
+        print("Usage: render_markdown.py <db_path> [--missing]")
+        sys.exit(1)
+
+    rendered = rerender_all(sys.argv[1], only_missing="--missing" in sys.argv[2:])
+    print(f"Rendered {rendered} entries.")
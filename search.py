@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# full-text search over file_entries with sqlite fts5
+import re
+import html
+import logging
+
+FTS_TABLE = "file_entries_fts"
+
+# Private-use markers around highlighted terms, swapped for <mark> after escaping
+HIGHLIGHT_START = "\ue000"
+HIGHLIGHT_END = "\ue001"
+
+
+def ensure_search_index(conn):
+    """Create the FTS5 index and the triggers that keep it in sync with file_entries.
+
+    The index uses file_entries as external content, so it stores no second copy
+    of the texts. Returns False if this SQLite build lacks FTS5.
+    """
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (FTS_TABLE,)).fetchone()
+    if exists:
+        return True
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'file_entries'").fetchone():
+        return False
+    try:
+        with conn:
+            conn.execute(f"""
+                CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(
+                    content, filename,
+                    content='file_entries', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2'
+                )""")
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS file_entries_fts_insert AFTER INSERT ON file_entries BEGIN
+                    INSERT INTO {FTS_TABLE}(rowid, content, filename) VALUES (new.id, new.content, new.filename);
+                END""")
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS file_entries_fts_delete AFTER DELETE ON file_entries BEGIN
+                    INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content, filename) VALUES ('delete', old.id, old.content, old.filename);
+                END""")
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS file_entries_fts_update AFTER UPDATE OF content, filename ON file_entries BEGIN
+                    INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content, filename) VALUES ('delete', old.id, old.content, old.filename);
+                    INSERT INTO {FTS_TABLE}(rowid, content, filename) VALUES (new.id, new.content, new.filename);
+                END""")
+            # Index the rows that were imported before the search index existed
+            conn.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+        logging.info("Created full-text search index")
+        return True
+    except Exception as e:
+        logging.error(f"Could not create full-text search index: {e}")
+        return False
+
+
+def build_match_query(query):
+    """Turn free text into an FTS5 query: every word must match, as a prefix."""
+    terms = re.findall(r"\w+", query or "")
+    return " ".join('"%s"*' % term for term in terms)
+
+
+def highlight(snippet):
+    """Escape a snippet and turn the highlight markers into <mark> tags."""
+    escaped = html.escape(snippet or "")
+    return escaped.replace(HIGHLIGHT_START, "<mark>").replace(HIGHLIGHT_END, "</mark>")
+
+
+def search_entries(conn, query, page=1, per_page=20):
+    """Ranked hits for a query as (hits, total). Each hit is a dictionary."""
+    match = build_match_query(query)
+    if not match:
+        return [], 0
+
+    cursor = conn.cursor()
+    total = cursor.execute(f"SELECT COUNT(*) FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH ?", (match,)).fetchone()[0]
+    cursor.execute(f"""
+            SELECT f.id, f.parent_id, f.filename, f.entry_type, f.file_type,
+                   snippet({FTS_TABLE}, 0, ?, ?, '…', 16)
+            FROM {FTS_TABLE}
+            JOIN file_entries f ON f.id = {FTS_TABLE}.rowid
+            WHERE {FTS_TABLE} MATCH ?
+            ORDER BY bm25({FTS_TABLE}, 1.0, 0.5)
+            LIMIT ? OFFSET ?
+    """, (HIGHLIGHT_START, HIGHLIGHT_END, match, per_page, (max(page, 1) - 1) * per_page))
+
+    hits = [{
+            "id": id_,
+            "parent_id": parent_id,
+            "filename": filename,
+            "entry_type": entry_type,
+            "file_type": file_type,
+            "snippet": highlight(snippet)
+    } for id_, parent_id, filename, entry_type, file_type, snippet in cursor.fetchall()]
+    return hits, total
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# static media serving with conditional requests and byte ranges
+import os
+import re
+import mimetypes
+from email.utils import formatdate
+
+BLOCK_SIZE = 64 * 1024
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class RangeFileWrapper:
+    """Iterates over length bytes of a file starting at offset."""
+
+    def __init__(self, f, offset, length, block_size=BLOCK_SIZE):
+        self.f = f
+        self.remaining = length
+        self.block_size = block_size
+        f.seek(offset)
+
+    def __iter__(self):
+        while self.remaining > 0:
+            data = self.f.read(min(self.block_size, self.remaining))
+            if not data:
+                break
+            self.remaining -= len(data)
+            yield data
+
+    def close(self):
+        self.f.close()
+
+
+def parse_range(header, size):
+    """Parse a single 'bytes=' range into (start, end) inclusive, None if absent or unsupported, False if unsatisfiable."""
+    match = RANGE_RE.match(header.strip()) if header else None
+    if not match:
+        # Multiple ranges are answered with the full file
+        return None
+    first, last = match.groups()
+    if first == "" and last == "":
+        return None
+    if first == "":
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+
+def serve_file(environ, start_response, file_path, max_age=86400):
+    """Send a file with ETag/Last-Modified validators and HTTP Range support."""
+    st = os.stat(file_path)
+    size = st.st_size
+    etag = '"%x-%x"' % (st.st_mtime_ns, size)
+    content_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+    headers = [('ETag', etag),
+               ('Last-Modified', formatdate(st.st_mtime, usegmt=True)),
+               ('Cache-Control', f'public, max-age={max_age}'),
+               ('Accept-Ranges', 'bytes')]
+
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match and ('*' in if_none_match or etag in [t.strip() for t in if_none_match.split(',')]):
+        start_response('304 Not Modified', headers)
+        return [b""]
+
+    byte_range = None
+    if_range = environ.get('HTTP_IF_RANGE')
+    if 'HTTP_RANGE' in environ and (not if_range or if_range.strip() == etag):
+        byte_range = parse_range(environ['HTTP_RANGE'], size)
+        if byte_range is False:
+            start_response('416 Range Not Satisfiable', headers + [('Content-Range', f'bytes */{size}')])
+            return [b""]
+
+    head_only = environ.get('REQUEST_METHOD') == 'HEAD'
+    if byte_range:
+        start, end = byte_range
+        length = end - start + 1
+        start_response('206 Partial Content', headers + [
+                ('Content-Type', content_type),
+                ('Content-Range', f'bytes {start}-{end}/{size}'),
+                ('Content-Length', str(length))])
+        if head_only:
+            return [b""]
+        return RangeFileWrapper(open(file_path, 'rb'), start, length)
+
+    start_response('200 OK', headers + [('Content-Type', content_type), ('Content-Length', str(size))])
+    if head_only:
+        return [b""]
+    f = open(file_path, 'rb')
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None:
+        # Lets mod_wsgi hand the file to sendfile() instead of copying it through Python
+        return file_wrapper(f, BLOCK_SIZE)
+    return RangeFileWrapper(f, 0, size)
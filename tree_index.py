@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# in-memory index of the folder tree stored in file_entries
+import logging
+
+
+def build_site_map(rows):
+    """Nest (id, display_name, parent_id, level) rows into a tree in one pass.
+
+    Parents must come before their children. Only rows with parent_id NULL
+    become roots; orphaned rows are dropped.
+    """
+    lookup = {}
+    roots = []
+    for id_, display_name, parent_id, level in rows:
+        entry = {"id": id_, "display_name": display_name, "parent_id": parent_id, "level": level, "children": []}
+        lookup[id_] = entry
+        parent = lookup.get(parent_id)
+        if parent is not None:
+            parent["children"].append(entry)
+        elif parent_id is None:
+            roots.append(entry)
+    return roots
+
+
+class TreeIndex:
+    """Read-only snapshot of the file_entries hierarchy for navigation lookups."""
+
+    def __init__(self, rows):
+        # rows: (id, parent_id, filename, entry_type, position_marker, content)
+        self.nodes = {}
+        self.children = {}
+        for id_, parent_id, filename, entry_type, position_marker, content in rows:
+            self.nodes[id_] = {
+                    "id": id_,
+                    "parent_id": parent_id,
+                    "filename": filename,
+                    "entry_type": entry_type,
+                    "position_marker": position_marker,
+                    "content": content,
+                    "level": 0
+            }
+            self.children.setdefault(parent_id, []).append(id_)
+
+        # Same ordering as "ORDER BY position_marker ASC, id ASC" (NULLs first)
+        for ids in self.children.values():
+            ids.sort(key=lambda i: self._sort_key(self.nodes[i]))
+
+        self.ancestors = {}
+        self.sibling_nav = {}
+        self._build_navigation()
+        # Artefacts derived from this snapshot (site map, rendered fragments), dropped on edits
+        self.cache = {}
+
+    @classmethod
+    def load(cls, conn):
+        """Load the index from an open database connection."""
+        cursor = conn.cursor()
+        # File content is only needed for folder titles and top-level entries
+        cursor.execute("""
+                SELECT id, parent_id, filename, entry_type, position_marker,
+                       CASE WHEN entry_type = 'folder' OR parent_id IS NULL THEN content END
+                FROM file_entries
+        """)
+        index = cls(cursor.fetchall())
+        logging.debug(f"Loaded tree index with {len(index.nodes)} entries")
+        return index
+
+    @staticmethod
+    def _sort_key(node):
+        marker = node["position_marker"]
+        return (marker is not None, marker if marker is not None else 0, node["id"])
+
+    @staticmethod
+    def display_name(node):
+        """Folder title with the filename as fallback, like COALESCE(content, filename)."""
+        return node["content"] if node["content"] is not None else node["filename"]
+
+    def _build_navigation(self):
+        """Precompute ancestor chains, levels and previous/next sibling folders."""
+        self.preorder = []
+        stack = [(root_id, ()) for root_id in reversed(self.children.get(None, []))]
+        while stack:
+            node_id, chain = stack.pop()
+            chain = chain + (node_id,)
+            self.preorder.append(node_id)
+            self.ancestors[node_id] = chain
+            self.nodes[node_id]["level"] = len(chain) - 1
+
+            child_ids = self.children.get(node_id, [])
+            stack.extend((child_id, chain) for child_id in reversed(child_ids))
+        self._link_siblings()
+
+    def _link_siblings(self):
+        self.sibling_nav = {}
+        for child_ids in self.children.values():
+            folders = [i for i in child_ids if self.nodes[i]["entry_type"] == "folder"]
+            for pos, folder_id in enumerate(folders):
+                previous_id = folders[pos - 1] if pos > 0 else None
+                next_id = folders[pos + 1] if pos < len(folders) - 1 else None
+                self.sibling_nav[folder_id] = (previous_id, next_id)
+
+    def get(self, entry_id):
+        """Return the node for an id (int or numeric string), or None."""
+        try:
+            return self.nodes.get(int(entry_id))
+        except (TypeError, ValueError):
+            return None
+
+    def main_entries(self):
+        """Top-level entries as (id, filename, entry_type, content) tuples."""
+        return [(n["id"], n["filename"], n["entry_type"], n["content"])
+                for n in (self.nodes[i] for i in self.children.get(None, []))]
+
+    def breadcrumbs(self, entry_id):
+        """Ancestor chain (root first, entry last) and the media base path."""
+        node = self.get(entry_id)
+        if node is None:
+            return [], ""
+        crumbs = [{"id": n["id"], "filename": n["filename"], "level": n["level"]}
+                  for n in (self.nodes[i] for i in self.ancestors.get(node["id"], (node["id"],)))]
+        base_path = "/".join([crumb["filename"] for crumb in crumbs if crumb["id"] != 1])
+        return crumbs, base_path
+
+    def siblings(self, entry_id):
+        """Previous and next sibling folders as (id, display_name) tuples."""
+        node = self.get(entry_id)
+        if node is None:
+            return None, None
+        return tuple(
+            (i, self.display_name(self.nodes[i]).strip()) if i is not None else None
+            for i in self.sibling_nav.get(node["id"], (None, None))
+        )
+
+    def site_map(self):
+        """Folder tree as nested dictionaries, built in a single pass and cached."""
+        site_map = self.cache.get("site_map")
+        if site_map is None:
+            site_map = build_site_map(
+                (n["id"], self.display_name(n), n["parent_id"], n["level"])
+                for n in (self.nodes[i] for i in self.preorder)
+                if n["entry_type"] == "folder"
+            )
+            self.cache["site_map"] = site_map
+        return site_map
+
+    def update_content(self, entry_id, content):
+        """Patch a folder title or top-level entry after an edit."""
+        node = self.get(entry_id)
+        if node is None:
+            return False
+        if node["entry_type"] == "folder" or node["parent_id"] is None:
+            node["content"] = content
+            self.cache.clear()
+            return True
+        return False